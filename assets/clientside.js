@@ -0,0 +1,130 @@
+// decoded typed arrays of the current dataset, the store only changes when the data does
+var decodedMapData = {version: null};
+
+// {dtype, bdata} as sent by encode_array in datastore.py
+function decodeArray(encoded) {
+    var binary = atob(encoded.bdata);
+    var bytes = new Uint8Array(binary.length);
+    for (var i = 0; i < binary.length; i++) {
+        bytes[i] = binary.charCodeAt(i);
+    }
+    var types = {'i1': Int8Array, 'u1': Uint8Array, 'i2': Int16Array, 'u2': Uint16Array,
+                 'i4': Int32Array, 'u4': Uint32Array, 'f4': Float32Array, 'f8': Float64Array};
+    return new types[encoded.dtype](bytes.buffer);
+}
+
+function decodeMapData(mapData) {
+    if (decodedMapData.version === mapData.version) {
+        return decodedMapData;
+    }
+    var country = decodeArray(mapData.country);
+    var metrics = mapData.metrics.map(decodeArray);
+    var text = new Array(country.length);
+    var customdata = new Array(country.length);
+    var size = new Float32Array(country.length);
+    for (var i = 0; i < country.length; i++) {
+        text[i] = mapData.countries[country[i]];
+        customdata[i] = [metrics[0][i], metrics[1][i], metrics[2][i], metrics[3][i]];
+        size[i] = metrics[0][i] / 1000;
+    }
+    decodedMapData = {
+        version: mapData.version,
+        lat: decodeArray(mapData.lat),
+        lon: decodeArray(mapData.lon),
+        confirmed: metrics[0],
+        size: size,
+        text: text,
+        customdata: customdata
+    };
+    return decodedMapData;
+}
+
+// kpi values of the current dataset and the row of each country in them
+var decodedKpiData = {version: null};
+
+function decodeKpiData(kpiData) {
+    if (decodedKpiData.version === kpiData.version) {
+        return decodedKpiData;
+    }
+    var rows = {};
+    kpiData.countries.forEach(function(country, i) {
+        rows[country] = i;
+    });
+    decodedKpiData = {version: kpiData.version, values: decodeArray(kpiData.values), rows: rows};
+    return decodedKpiData;
+}
+
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    covid: {
+        // the four kpi cards: last daily change of each metric against the change the day before
+        kpi_figures: function(kpiData, country) {
+            var noUpdate = window.dash_clientside.no_update;
+            if (!kpiData || decodeKpiData(kpiData).rows[country] === undefined) {
+                return [noUpdate, noUpdate, noUpdate, noUpdate];
+            }
+            var decoded = decodeKpiData(kpiData);
+            var row = decoded.rows[country];
+            var metricCount = kpiData.cards.length;
+            var days = kpiData.days;
+            return kpiData.cards.map(function(card) {
+                var value = function(daysBack) {
+                    return decoded.values[(row * days + days - daysBack) * metricCount + card.metric];
+                };
+                return {
+                    data: [{
+                        type: 'indicator',
+                        mode: 'number+delta',
+                        value: value(1) - value(2),
+                        delta: {reference: value(2) - value(3), position: 'right', valueformat: 'g', relative: false, font: {size: 15}},
+                        number: {valueformat: ',', font: {size: 20}},
+                        domain: {y: [0, 1], x: [0, 1]}
+                    }],
+                    layout: card.layout
+                };
+            });
+        },
+
+        // every location on one map, the selected country highlighted and centered
+        map_figure: function(mapData, country) {
+            if (!mapData) {
+                return window.dash_clientside.no_update;
+            }
+            var decoded = decodeMapData(mapData);
+            var trace = {
+                type: 'scattermapbox',
+                lat: decoded.lat,
+                lon: decoded.lon,
+                mode: 'markers',
+                marker: {size: decoded.size, color: decoded.confirmed, colorscale: 'HSV', showscale: false, sizemode: 'area', opacity: 0.3},
+                text: decoded.text,
+                customdata: decoded.customdata,
+                hovertemplate:
+                    '<b>Country</b>: %{text}<br>' +
+                    '<b>Longitude</b>: %{lon:.4f}<br>' +
+                    '<b>Latitude</b>: %{lat:.4f}<br>' +
+                    '<b>Confirmed Cases</b>: %{customdata[0]:,.0f}<br>' +
+                    '<b>Deaths</b>: %{customdata[1]:,.0f}<br>' +
+                    '<b>Recovered Cases</b>: %{customdata[2]:,.0f}<br>' +
+                    '<b>Active Cases</b>: %{customdata[3]:,.0f}<br><extra></extra>'
+            };
+
+            var layout = JSON.parse(JSON.stringify(mapData.layout));
+            var rows = mapData.slices[country];
+            if (rows) {
+                var selected = [];
+                for (var i = rows[0]; i < rows[1]; i++) {
+                    selected.push(i);
+                }
+                trace.selectedpoints = selected;
+                trace.selected = {marker: {opacity: 0.9}};
+                trace.unselected = {marker: {opacity: 0.15}};
+            }
+            var center = mapData.centers[country];
+            // a country without coordinates keeps the default view
+            if (center && center.Lat !== null && center.Long !== null) {
+                layout.mapbox.center = {lat: center.Lat, lon: center.Long};
+            }
+            return {data: [trace], layout: layout};
+        }
+    }
+});
@@ -0,0 +1,292 @@
+import os
+import sys
+import json
+import time
+import random
+import socket
+import tempfile
+import warnings
+import argparse
+import gzip
+import datetime
+import subprocess
+import tracemalloc
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+import datastore
+
+#github links to datasets
+url_confirmed = 'https://raw.githubusercontent.com/CSSEGISandData/COVID-19/master/csse_covid_19_data/csse_covid_19_time_series/time_series_covid19_confirmed_global.csv'
+url_deaths = 'https://raw.githubusercontent.com/CSSEGISandData/COVID-19/master/csse_covid_19_data/csse_covid_19_time_series/time_series_covid19_deaths_global.csv'
+url_recovered = 'https://raw.githubusercontent.com/CSSEGISandData/COVID-19/master/csse_covid_19_data/csse_covid_19_time_series/time_series_covid19_recovered_global.csv'
+
+#write a synthetic data set in the JHU wide csv format, the first countries are split into
+#provinces and like Canada in the real files the first of them has one country-level recovered row
+def generate_dataset(directory, countries, provinces, days, seed=0):
+    rng = np.random.default_rng(seed)
+    #the app selects US on load
+    names = ['US'] + [f'Country {i:03d}' for i in range(1, countries)]
+    rows = []
+    for i, name in enumerate(names):
+        count = provinces // countries + (i < provinces % countries)
+        for p in range(count):
+            rows.append((f'{name} Province {p:03d}', name))
+        if count == 0:
+            rows.append((None, name))
+    lat = rng.uniform(-60, 70, len(rows)).round(4)
+    long = rng.uniform(-180, 180, len(rows)).round(4)
+    start = datetime.date(2020, 1, 22)
+    dates = [start + datetime.timedelta(days=d) for d in range(days)]
+    date_columns = [f'{d.month}/{d.day}/{d.year % 100}' for d in dates]
+
+    ids = pd.DataFrame({'Province/State': [p for p, _ in rows], 'Country/Region': [c for _, c in rows], 'Lat': lat, 'Long': long})
+
+    def table(scale):
+        values = np.cumsum(rng.poisson(scale, (len(rows), days)), axis=1)
+        return pd.concat([ids, pd.DataFrame(values, columns=date_columns)], axis=1)
+
+    confirmed = table(50)
+    deaths = table(1)
+    recovered = table(20)
+    if provinces:
+        split = (recovered['Country/Region'] == names[0]).to_numpy()
+        national = recovered[split].iloc[:1].copy()
+        national['Province/State'] = None
+        national[date_columns] = recovered.loc[split, date_columns].sum().to_numpy()
+        recovered = pd.concat([recovered[~split], national], ignore_index=True)
+
+    paths = {}
+    for name, frame in [('confirmed', confirmed), ('deaths', deaths), ('recovered', recovered)]:
+        paths[name] = os.path.join(directory, f'time_series_covid19_{name}_global.csv')
+        frame.to_csv(paths[name], index=False)
+    return paths
+
+#the original melt + merge ingestion, kept as the baseline to compare against
+def melt_merge(confirmed, deaths, recovered):
+    date1 = confirmed.columns[4:]
+    total_confirmed = confirmed.melt(id_vars = ['Province/State','Country/Region','Lat','Long'],value_vars = date1,var_name = 'date',value_name = 'confirmed')
+    date2 = deaths.columns[4:]
+    total_deaths = deaths.melt(id_vars = ['Province/State','Country/Region','Lat','Long'],value_vars = date2,var_name = 'date',value_name = 'deaths')
+    date3 = recovered.columns[4:]
+    total_recovered = recovered.melt(id_vars = ['Province/State','Country/Region','Lat','Long'],value_vars = date3,var_name = 'date',value_name = 'recovered')
+
+    covid_data = total_confirmed.merge(right= total_deaths, how = 'left',on = ['Province/State','Country/Region','Lat','Long','date'])
+    covid_data = covid_data.merge(right= total_recovered, how = 'left',on = ['Province/State','Country/Region','Lat','Long','date'])
+    covid_data['date'] = pd.to_datetime(covid_data['date'])
+    covid_data['recovered'] = covid_data['recovered'].fillna(0)
+    covid_data['active'] = covid_data['confirmed'] - covid_data['deaths'] - covid_data['recovered']
+    return covid_data
+
+#the aligned block ingestion used by the app, returned as a long frame with one row per date and
+#location indexed by (date, location id) to compare with the baseline. the counts are a view of
+#the value block, so no second copy is made
+def aligned_blocks(confirmed, deaths, recovered):
+    locations, dates, values, extra = datastore.ingest(confirmed, deaths, recovered)
+    n_dates, n_locations = values.shape[:2]
+    index = pd.MultiIndex.from_product([dates, pd.RangeIndex(n_locations, name='location')], names=['date', 'location'])
+    return pd.DataFrame(values.reshape(n_dates * n_locations, len(datastore.metrics)), index=index, columns=datastore.metrics, copy=False)
+
+#best wall time and peak traced allocation of one ingestion function
+def measure(func, tables, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(*tables)
+        best = min(best, time.perf_counter() - start)
+
+    tracemalloc.start()
+    result = func(*tables)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return best, peak, result
+
+def bench_ingest(args):
+    sources = [args.confirmed, args.deaths, args.recovered]
+    if args.synthetic:
+        paths = generate_dataset(tempfile.mkdtemp(prefix='covid-bench-'), *args.synthetic)
+        sources = [paths['confirmed'], paths['deaths'], paths['recovered']]
+    tables = [pd.read_csv(source) for source in sources]
+    print(f"{len(tables[0])} locations x {len(tables[0].columns) - 4} dates")
+    print(f"{'path':<16}{'wall (ms)':>12}{'peak (MiB)':>12}{'frame (MiB)':>13}")
+    for name, func in [('melt_merge', melt_merge), ('aligned_blocks', aligned_blocks)]:
+        seconds, peak, frame = measure(func, tables, args.repeat)
+        print(f"{name:<16}{seconds * 1000:>12.1f}{peak / 2**20:>12.1f}{frame.memory_usage(deep=True).sum() / 2**20:>13.1f}")
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+#peak resident memory of a process in bytes, linux only
+def peak_rss(pid):
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+#direct child processes, the gunicorn workers of its master, linux only
+def child_pids(pid):
+    try:
+        with open(f'/proc/{pid}/task/{pid}/children') as f:
+            return [int(child) for child in f.read().split()]
+    except OSError:
+        return []
+
+#proportional set size of a process and its children in bytes, pages shared by n processes
+#count 1/n to each, linux only
+def tree_pss(pid):
+    total = 0
+    try:
+        with open(f'/proc/{pid}/smaps_rollup') as f:
+            for line in f:
+                if line.startswith('Pss:'):
+                    total += int(line.split()[1]) * 1024
+    except OSError:
+        return None
+    for child in child_pids(pid):
+        total += tree_pss(child) or 0
+    return total
+
+#posts like a browser, which always accepts gzip
+def post_json(url, body):
+    request = urllib.request.Request(url, data=json.dumps(body).encode(), headers={'Content-Type': 'application/json', 'Accept-Encoding': 'gzip'})
+    with urllib.request.urlopen(request, timeout=60) as response:
+        data = response.read()
+        return gzip.decompress(data) if response.headers.get('Content-Encoding') == 'gzip' else data
+
+#request bodies for every server-side callback that depends on the country dropdown or the data stores,
+#in the shape the dash renderer posts to /_dash-update-component
+def callback_bodies(dependencies, country):
+    bodies = []
+    for dependency in dependencies:
+        if dependency.get('clientside_function'):
+            continue
+        output = dependency['output']
+        if output.startswith('..'):
+            outputs = [{'id': o.rsplit('.', 1)[0], 'property': o.rsplit('.', 1)[1]} for o in output.strip('.').split('...')]
+        else:
+            outputs = {'id': output.rsplit('.', 1)[0], 'property': output.rsplit('.', 1)[1]}
+        #the selected country, the default chart options and a first refresh tick
+        values = {'w_countries': country, 'rolling_window': datastore.rolling_windows[0], 'data_refresh': 0,
+                  'compare_countries': [country], 'compare_metric': 'confirmed', 'compare_series': datastore.rolling_windows[0]}
+        inputs = [{'id': i['id'], 'property': i['property'], 'value': values.get(i['id'])} for i in dependency['inputs']]
+        state = [{'id': s['id'], 'property': s['property'], 'value': values.get(s['id'])} for s in dependency['state']]
+        bodies.append({'output': output, 'outputs': outputs, 'inputs': inputs, 'state': state, 'changedPropIds': [f"{inputs[0]['id']}.{inputs[0]['property']}"]})
+    return bodies
+
+#start the app on a synthetic data set and drive its callbacks from concurrent clients
+def run_load(args, countries, provinces, days):
+    directory = tempfile.mkdtemp(prefix='covid-bench-')
+    paths = generate_dataset(directory, countries, provinces, days)
+    port = free_port()
+    env = dict(os.environ,
+               COVID_URL_CONFIRMED=paths['confirmed'], COVID_URL_DEATHS=paths['deaths'], COVID_URL_RECOVERED=paths['recovered'],
+               COVID_REFRESH_INTERVAL='0', COVID_SNAPSHOT_DIR='', COVID_CACHE_SIZE=str(args.cache_size))
+    #the development server in one process, or the production entry point with --workers
+    if args.workers:
+        command = [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', 'wsgi:application']
+        env.update(COVID_BIND=f'127.0.0.1:{port}', COVID_WORKERS=str(args.workers))
+    else:
+        command = [sys.executable, '-c', f"import covid; covid.app.run_server(host='127.0.0.1', port={port}, debug=False, threaded=True)"]
+    base = f'http://127.0.0.1:{port}'
+
+    start = time.perf_counter()
+    server = subprocess.Popen(command, cwd=os.path.dirname(os.path.abspath(__file__)), env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        while True:
+            if server.poll() is not None:
+                raise RuntimeError('the dashboard exited during startup')
+            try:
+                urllib.request.urlopen(base + '/', timeout=1).read()
+                break
+            except OSError:
+                time.sleep(0.05)
+        startup = time.perf_counter() - start
+
+        with urllib.request.urlopen(base + '/_dash-dependencies') as response:
+            dependencies = json.load(response)
+        names = ['US'] + [f'Country {i:03d}' for i in range(1, countries)]
+        rng = random.Random(0)
+        requests = [body for _ in range(args.requests) for body in callback_bodies(dependencies, rng.choice(names))][:args.requests]
+
+        def timed(body):
+            t = time.perf_counter()
+            post_json(base + '/_dash-update-component', body)
+            return time.perf_counter() - t
+
+        with ThreadPoolExecutor(args.concurrency) as pool:
+            list(pool.map(timed, requests[:args.concurrency]))
+            start = time.perf_counter()
+            latencies = np.array(list(pool.map(timed, requests)))
+            wall = time.perf_counter() - start
+        #the requests are served by the workers, the master only holds the preloaded data
+        rss = max((peak_rss(pid) or 0 for pid in child_pids(server.pid)), default=None) if args.workers else peak_rss(server.pid)
+        pss = tree_pss(server.pid)
+    finally:
+        server.terminate()
+        server.wait()
+
+    return {
+        'countries': countries, 'provinces': provinces, 'days': days,
+        'requests': len(latencies), 'concurrency': args.concurrency, 'cache_size': args.cache_size, 'workers': args.workers,
+        'startup_s': round(startup, 3),
+        'p50_ms': round(float(np.percentile(latencies, 50)) * 1000, 2),
+        'p99_ms': round(float(np.percentile(latencies, 99)) * 1000, 2),
+        'throughput_rps': round(len(latencies) / wall, 1),
+        'peak_rss_mib': round(rss / 2**20, 1) if rss is not None else None,
+        'pss_mib': round(pss / 2**20, 1) if pss is not None else None
+    }
+
+def bench_load(args):
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    columns = ['countries', 'provinces', 'days', 'workers', 'startup_s', 'p50_ms', 'p99_ms', 'throughput_rps', 'peak_rss_mib', 'pss_mib']
+    print(''.join(f'{c:>16}' for c in columns))
+    for countries, provinces, days in args.size:
+        result = run_load(args, countries, provinces, days)
+        result.update(commit=commit, time=datetime.datetime.now().isoformat(timespec='seconds'))
+        print(''.join(f'{str(result[c]):>16}' for c in columns))
+        if args.output:
+            with open(args.output, 'a') as f:
+                f.write(json.dumps(result) + '\n')
+
+#'countries,provinces,days'
+def size(text):
+    countries, provinces, days = (int(part) for part in text.split(','))
+    return countries, provinces, days
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks for the covid dashboard')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    ingest = commands.add_parser('ingest', help='compare the melt + merge ingestion with the aligned block ingestion')
+    ingest.add_argument('--confirmed', default=url_confirmed)
+    ingest.add_argument('--deaths', default=url_deaths)
+    ingest.add_argument('--recovered', default=url_recovered)
+    ingest.add_argument('--synthetic', type=size, metavar='COUNTRIES,PROVINCES,DAYS', help='use a generated data set instead of the sources')
+    ingest.add_argument('--repeat', type=int, default=5)
+    ingest.set_defaults(run=bench_ingest)
+
+    load = commands.add_parser('load', help='drive the dashboard callbacks through /_dash-update-component on synthetic data')
+    load.add_argument('--size', type=size, action='append', metavar='COUNTRIES,PROVINCES,DAYS', help='data set size, can be repeated (default 50,100,600 and 200,400,1000)')
+    load.add_argument('--requests', type=int, default=500)
+    load.add_argument('--concurrency', type=int, default=8)
+    load.add_argument('--cache-size', type=int, default=256, help='figure cache entries in the app, 0 measures uncached callbacks')
+    load.add_argument('--workers', type=int, default=0, help='serve through gunicorn with this many workers, 0 uses the development server')
+    load.add_argument('--output', help='append one json line per size to this file, tagged with the current commit')
+    load.set_defaults(run=bench_load)
+
+    #the baseline's pd.to_datetime without a format warns once per call
+    warnings.simplefilter('ignore', UserWarning)
+    args = parser.parse_args()
+    if args.command == 'load' and not args.size:
+        args.size = [(50, 100, 600), (200, 400, 1000)]
+    args.run(args)
@@ -0,0 +1,21 @@
+import gzip
+import flask
+
+#gzip the json responses (callbacks, stores, layout) for clients that accept it,
+#small bodies are sent as they are and level 0 turns compression off
+def compress_json(server, level=6, min_size=1024):
+    if level <= 0:
+        return
+
+    @server.after_request
+    def gzip_response(response):
+        if (response.direct_passthrough or response.status_code != 200 or response.mimetype != 'application/json'
+                or 'Content-Encoding' in response.headers or 'gzip' not in flask.request.headers.get('Accept-Encoding', '')):
+            return response
+        data = response.get_data()
+        if len(data) < min_size:
+            return response
+        response.set_data(gzip.compress(data, compresslevel=level))
+        response.headers['Content-Encoding'] = 'gzip'
+        response.vary.add('Accept-Encoding')
+        return response
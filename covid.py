@@ -1,281 +1,273 @@
+import os
+import flask
 import dash
 import dash_html_components as html
 import dash_core_components as dcc
-from dash.dependencies import Input, Output
+from dash.dependencies import Input, Output, State, ClientsideFunction
+from dash.exceptions import PreventUpdate
 import plotly.graph_objects as go
+import numpy as np
 import pandas as pd
-
-#github links to datasets
-url_confirmed = 'https://raw.githubusercontent.com/CSSEGISandData/COVID-19/master/csse_covid_19_data/csse_covid_19_time_series/time_series_covid19_confirmed_global.csv'
-url_deaths = 'https://raw.githubusercontent.com/CSSEGISandData/COVID-19/master/csse_covid_19_data/csse_covid_19_time_series/time_series_covid19_deaths_global.csv'
-url_recovered = 'https://raw.githubusercontent.com/CSSEGISandData/COVID-19/master/csse_covid_19_data/csse_covid_19_time_series/time_series_covid19_recovered_global.csv'
-
-confirmed = pd.read_csv(url_confirmed)
-deaths = pd.read_csv(url_deaths)
-recovered = pd.read_csv(url_recovered)
-#unpivot the data
-date1 = confirmed.columns[4:]
-total_confirmed = confirmed.melt(id_vars = ['Province/State','Country/Region','Lat','Long'],value_vars = date1,var_name = 'date',value_name = 'confirmed')
-
-date2 = deaths.columns[4:]
-total_deaths = deaths.melt(id_vars = ['Province/State','Country/Region','Lat','Long'],value_vars = date2,var_name = 'date',value_name = 'deaths')
-
-date3 = recovered.columns[4:]
-total_recovered = recovered.melt(id_vars = ['Province/State','Country/Region','Lat','Long'],value_vars = date3,var_name = 'date',value_name = 'recovered')
-
-#combining dataframes together
-covid_data = total_confirmed.merge(right= total_deaths, how = 'left',on = ['Province/State','Country/Region','Lat','Long','date'])
-covid_data = covid_data.merge(right= total_recovered, how = 'left',on = ['Province/State','Country/Region','Lat','Long','date'])
-
-#change date format
-covid_data['date'] = pd.to_datetime(covid_data['date'])
-
-#fill NA's for recovered column
-covid_data['recovered'] = covid_data['recovered'].fillna(0)
-
-#new column named active
-covid_data['active'] = covid_data['confirmed'] - covid_data['deaths'] - covid_data['recovered']
-
-# new df for group by date
-covid_data_2 = covid_data.groupby(['date'])[['confirmed','deaths','recovered','active']].sum().reset_index()
-
-#create dict of list for map
-covid_data_list = covid_data[['Country/Region','Lat','Long']]
-dict_of_locations = covid_data_list.set_index('Country/Region')[['Lat','Long']].T.to_dict('dict')
-
+from datastore import metrics, metric_index, rolling_windows, DataRefresher, load_snapshot, encode_array
+from figure_cache import FigureCache, RedisBackend
+from downsample import lttb
+from compression import compress_json
+from instrumentation import Timings, SlowRequestProfiler, instrument_dash
+
+#github links to datasets, each can be pointed at another url or a local file path
+url_confirmed = os.environ.get('COVID_URL_CONFIRMED', 'https://raw.githubusercontent.com/CSSEGISandData/COVID-19/master/csse_covid_19_data/csse_covid_19_time_series/time_series_covid19_confirmed_global.csv')
+url_deaths = os.environ.get('COVID_URL_DEATHS', 'https://raw.githubusercontent.com/CSSEGISandData/COVID-19/master/csse_covid_19_data/csse_covid_19_time_series/time_series_covid19_deaths_global.csv')
+url_recovered = os.environ.get('COVID_URL_RECOVERED', 'https://raw.githubusercontent.com/CSSEGISandData/COVID-19/master/csse_covid_19_data/csse_covid_19_time_series/time_series_covid19_recovered_global.csv')
+
+#seconds between background refreshes, 0 disables the refresher
+refresh_interval = float(os.environ.get('COVID_REFRESH_INTERVAL', '3600'))
+#set by gunicorn.conf.py, a preloading server starts the refresher in each worker after the fork
+refresh_after_fork = os.environ.get('COVID_REFRESH_AFTER_FORK') == '1'
+
+#directory for the on-disk snapshot of the processed data, empty string disables it
+snapshot_dir = os.environ.get('COVID_SNAPSHOT_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'snapshot'))
+
+#built figures kept in process, COVID_CACHE_REDIS_URL also shares them between workers
+cache_size = int(os.environ.get('COVID_CACHE_SIZE', '256'))
+cache_redis_url = os.environ.get('COVID_CACHE_REDIS_URL')
+#number of most selected countries rebuilt right after each refresh
+cache_warm_countries = int(os.environ.get('COVID_CACHE_WARM', '10'))
+
+#days of cumulative values per country sent to the browser for the kpi cards, at least the three
+#their daily changes are computed from
+kpi_days = max(int(os.environ.get('COVID_KPI_DAYS', '3')), 3)
+
+#fraction of callback requests run under the profiler, 0 disables profiling,
+#profiles of sampled requests slower than COVID_PROFILE_SLOW_MS are written to COVID_PROFILE_DIR
+profile_sample = float(os.environ.get('COVID_PROFILE_SAMPLE', '0'))
+profile_slow_ms = float(os.environ.get('COVID_PROFILE_SLOW_MS', '500'))
+profile_dir = os.environ.get('COVID_PROFILE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'profiles'))
+
+#countries overlaid at most in the comparison chart and the points it sends for all of them together,
+#longer histories are downsampled to fit
+compare_max = int(os.environ.get('COVID_COMPARE_MAX', '30'))
+compare_points = int(os.environ.get('COVID_COMPARE_POINTS', '4000'))
+
+#gzip level of json responses, 0 disables compression, bodies under COVID_GZIP_MIN_SIZE bytes are sent as they are
+gzip_level = int(os.environ.get('COVID_GZIP_LEVEL', '6'))
+gzip_min_size = int(os.environ.get('COVID_GZIP_MIN_SIZE', '1024'))
+
+#'global' plots every location and highlights the selected country in the browser,
+#'country' builds a map of the selected country on the server
+map_mode = os.environ.get('COVID_MAP_MODE', 'global')
+
+#requests read this module-level name once per callback, so replacing it swaps the data atomically
+def set_dataset(new_dataset):
+    global dataset
+    dataset = new_dataset
+
+#per-callback and per-stage latency histograms, served at /metrics
+timings = Timings()
+
+refresher = DataRefresher({'confirmed': url_confirmed, 'deaths': url_deaths, 'recovered': url_recovered}, refresh_interval, snapshot_dir, timings)
+refresher.on_refresh.append(set_dataset)
+
+#start from the snapshot of these sources when there is one and let the refresher catch up with them,
+#without a background refresher they are checked once here and a change replaces the snapshot
+dataset = load_snapshot(snapshot_dir, urls=refresher.sources) if snapshot_dir else None
+if dataset is not None:
+    refresher.dataset = dataset
+    refresher.version = dataset['version']
+    if refresh_interval <= 0:
+        dataset = refresher.refresh() or dataset
+else:
+    dataset = refresher.refresh()
 
 #now we create dashapp
 app = dash.Dash(__name__, meta_tags=[{"name":"viewport", "content": "width=device-width"}])
-
-app.layout = html.Div([
-    html.Div([
-        html.Div([
-            html.Img(src=app.get_asset_url('covid19Logo.jpg'),id = 'corona-logo',style={'height': '60px','width':'auto','margin-bottom':'25px'})
-
-        ],className='one-third column'),
+instrument_dash(app, timings, SlowRequestProfiler(profile_sample, profile_slow_ms / 1000, profile_dir) if profile_sample > 0 else None)
+compress_json(app.server, gzip_level, gzip_min_size)
+
+#one global card of the header, read from the precomputed summary
+def header_card(summary, title, metric, color, show_new=True):
+    latest = summary[metric]
+    children = [
+        html.H6(children=title, style={'text-align':'center','color':'white'}),
+        html.P(f"{latest['value']:,.0f}",
+               style={'text-align':'center','color':color,'fontSize':'3vw'})
+    ]
+    if show_new:
+        children.append(html.P('new: ' + f"{latest['new']:,.0f}" + ' (' + str(latest['percent']) + '%)',
+                               style={'text-align':'center','color':color,'fontSize':15,'margin-top':'-18px'}))
+    #a metric that is no longer reported shows the date of its last value
+    if latest['date'] != summary['date']:
+        children.append(html.P('last reported: ' + latest['date'],
+                               style={'text-align':'center','color':color,'fontSize':15,'margin-top':'-18px'}))
+    return html.Div(children, className='card_container three columns')
+
+#built on every page load from the dataset being served, so a reload shows the latest refresh
+#without scanning any table
+def serve_layout():
+    data = dataset
+    summary = data['summary']
+    return html.Div([
         html.Div([
             html.Div([
-                html.H3('Covid-19',style={'margin-bottom':'0px','color':'white'}),
-                html.H5('Track Covid-19 Cases',style={'margin-bottom':'0px','color':'white'})
-            ])
-
-        ],className='one-half column',id='title'),
-
-        html.Div([
-            html.H6('Last Updated: '+ str(covid_data['date'].iloc[-1].strftime('%B %d, %Y'))+ ' 00:01 (UTC)', style={'color':'orange'})
-        ],className= 'one-third column', id='title1')
-
-    ], id = 'header', className='row flex-display',style={'margin-bottom':'25px'}),
-    #2nd row
-    html.Div([
-        html.Div([
-            html.H6(children='Global Cases', style={'text-align':'center','color':'white'}),
-            html.P(f"{covid_data_2['confirmed'].iloc[-1]:,.0f}",
-                   style={'text-align':'center','color':'orange','fontSize':'3vw'}),
-            html.P('new: ' + f"{covid_data_2['confirmed'].iloc[-1] - covid_data_2['confirmed'].iloc[-2]:,.0f}" + ' (' + str(round(((covid_data_2['confirmed'].iloc[-1] - covid_data_2['confirmed'].iloc[-2])/(covid_data_2['confirmed'].iloc[-1]))*100,2))+'%)',
-                   style={'text-align':'center','color':'orange','fontSize':15,'margin-top':'-18px'})
-
-        ],className='card_container three columns'),
-        #Column 2
-        html.Div([
-                    html.H6(children='Global Deaths', style={'text-align':'center','color':'white'}),
-                    html.P(f"{covid_data_2['deaths'].iloc[-1]:,.0f}",
-                           style={'text-align':'center','color':'red','fontSize':'3vw'}),
-                    html.P('new: ' + f"{covid_data_2['deaths'].iloc[-1] - covid_data_2['deaths'].iloc[-2]:,.0f}" + ' (' + str(round(((covid_data_2['deaths'].iloc[-1] - covid_data_2['deaths'].iloc[-2])/(covid_data_2['deaths'].iloc[-1]))*100,2))+'%)',
-                            style={'text-align':'center','color':'red','fontSize':15,'margin-top':'-18px'})
-
-                ],className='card_container three columns'),
-        #column 3
-        html.Div([
-            html.H6(children='Global Recovered', style={'text-align': 'center', 'color': 'white'}),
-            html.P(f"{covid_data_2['recovered'].iloc[560]:,.0f}",
-                   style={'text-align': 'center', 'color': 'green', 'fontSize': '3vw'})
+                html.Img(src=app.get_asset_url('covid19Logo.jpg'),id = 'corona-logo',style={'height': '60px','width':'auto','margin-bottom':'25px'})
 
-        ], className='card_container three columns'),
+            ],className='one-third column'),
+            html.Div([
+                html.Div([
+                    html.H3('Covid-19',style={'margin-bottom':'0px','color':'white'}),
+                    html.H5('Track Covid-19 Cases',style={'margin-bottom':'0px','color':'white'})
+                ])
 
-        #Column 4
-        html.Div([
-                    html.H6(children='Global Active', style={'text-align':'center','color':'white'}),
-                    html.P(f"{covid_data_2['active'].iloc[-1]:,.0f}",
-                           style={'text-align':'center','color':'#e55467','fontSize':'3vw'}),
-                    html.P('new: ' + f"{covid_data_2['active'].iloc[-1] - covid_data_2['active'].iloc[-2]:,.0f}" + ' (' + str(round(((covid_data_2['active'].iloc[-1] - covid_data_2['active'].iloc[-2])/(covid_data_2['active'].iloc[-1]))*100,2))+'%)',
-                            style={'text-align':'center','color':'#e55467','fontSize':15,'margin-top':'-18px'})
+            ],className='one-half column',id='title'),
 
-                ],className='card_container three columns')
+            html.Div([
+                html.H6('Last Updated: '+ summary['date']+ ' 00:01 (UTC)', style={'color':'orange'})
+            ],className= 'one-third column', id='title1')
 
-    ],className= 'row flex display'),
-    #third row
-    html.Div([
+        ], id = 'header', className='row flex-display',style={'margin-bottom':'25px'}),
+        #2nd row
         html.Div([
-            html.P('Select Country',className='fix_label',style={'color':'white'}),
-            #add dropdown now
-            dcc.Dropdown(id= 'w_countries',multi=False,searchable=True,value='US',placeholder='Select Country',
-                         options=[{'label': c,'value':c}
-                            for c in (covid_data['Country/Region'].unique())],className='dcc_compon'),
-            #add kpi1 to second column position
-            html.P('New Cases: '+' '+str(covid_data['date'].iloc[-1].strftime('%B %d, %Y')),className='fix_label',style={'text-align':'center','color':'white'}),
-            #add graph
-            dcc.Graph(id='confirmed', config={'displayModeBar':False},className='dcc_compon',style={'margin-top':'20px'}) ,
-            #create new graph
-            dcc.Graph(id='deaths', config={'displayModeBar':False},className='dcc_compon',style={'margin-top':'20px'}),
-            # create new graph
-            dcc.Graph(id='recovered', config={'displayModeBar': False}, className='dcc_compon',
-                      style={'margin-top': '20px'}),
-            dcc.Graph(id='active', config={'displayModeBar': False}, className='dcc_compon',
-                      style={'margin-top': '20px'})
-
-        ],className='create_container three columns'),
-
-        #second column donut chart
+            header_card(summary, 'Global Cases', 'confirmed', 'orange'),
+            header_card(summary, 'Global Deaths', 'deaths', 'red'),
+            header_card(summary, 'Global Recovered', 'recovered', 'green', show_new=False),
+            header_card(summary, 'Global Active', 'active', '#e55467')
+        ],className= 'row flex display'),
+        #third row
         html.Div([
-            #pie chart
-            dcc.Graph(id='pie_chart',config={'displayModeBar':'hover'})
+            html.Div([
+                html.P('Select Country',className='fix_label',style={'color':'white'}),
+                #add dropdown now
+                dcc.Dropdown(id= 'w_countries',multi=False,searchable=True,value='US',placeholder='Select Country',
+                             options=[{'label': c,'value':c}
+                                for c in data['country_index']],className='dcc_compon'),
+                #add kpi1 to second column position
+                html.P('New Cases: '+' '+summary['date'],className='fix_label',style={'text-align':'center','color':'white'}),
+                #add graph
+                dcc.Graph(id='confirmed', config={'displayModeBar':False},className='dcc_compon',style={'margin-top':'20px'}) ,
+                #create new graph
+                dcc.Graph(id='deaths', config={'displayModeBar':False},className='dcc_compon',style={'margin-top':'20px'}),
+                # create new graph
+                dcc.Graph(id='recovered', config={'displayModeBar': False}, className='dcc_compon',
+                          style={'margin-top': '20px'}),
+                dcc.Graph(id='active', config={'displayModeBar': False}, className='dcc_compon',
+                          style={'margin-top': '20px'}),
+                #last days of every country for the kpi cards, sent once per dataset
+                dcc.Store(id='kpi_data')
+
+            ],className='create_container three columns'),
+
+            #second column donut chart
+            html.Div([
+                #pie chart
+                dcc.Graph(id='pie_chart',config={'displayModeBar':'hover'})
 
-        ],className='create_container four columns'),
+            ],className='create_container four columns'),
 
-        # third column line/bar chart
+            # third column line/bar chart
+            html.Div([
+                # line/bar chart
+                dcc.Graph(id='line_chart', config={'displayModeBar': 'hover'}),
+                #rolling average window and date range of the line/bar chart
+                html.Div([
+                    dcc.RadioItems(id='rolling_window', value=rolling_windows[0],
+                                   options=[{'label': f'{w}-day avg', 'value': w} for w in rolling_windows],
+                                   labelStyle={'display': 'inline-block', 'margin-right': '10px'}, style={'color': 'white'}),
+                    dcc.DatePickerRange(id='line_dates', display_format='MMM D, YYYY',
+                                        start_date_placeholder_text='Last 30 days', end_date_placeholder_text='Latest',
+                                        min_date_allowed=data['cube_dates'][0].date(), max_date_allowed=data['cube_dates'][-1].date(),
+                                        clearable=True)
+                ], className='dcc_compon')
+            #!!!!there are 12 columns in one row, this one is 5, pie is 4, Kpi is 3
+            ], className='create_container five columns'),
+
+        ],className='row flex display'),
+
+        #comparison row
         html.Div([
-            # line/bar chart
-            dcc.Graph(id='line_chart', config={'displayModeBar': 'hover'})
-        #!!!!there are 12 columns in one row, this one is 5, pie is 4, Kpi is 3
-        ], className='create_container five columns'),
-
-    ],className='row flex display'),
-
-    #fourth row
-    html.Div([
-        # third row map chart
+            html.Div([
+                html.P('Compare Countries',className='fix_label',style={'color':'white'}),
+                dcc.Dropdown(id='compare_countries',multi=True,searchable=True,value=['US'],placeholder='Select Countries',
+                             options=[{'label': c,'value':c} for c in data['country_index']],className='dcc_compon'),
+                html.Div([
+                    dcc.RadioItems(id='compare_metric', value='confirmed',
+                                   options=[{'label': m.capitalize(), 'value': m} for m in metrics],
+                                   labelStyle={'display': 'inline-block', 'margin-right': '10px'}, style={'color': 'white'}),
+                    #0 plots the daily values, any other value the rolling average over that many days
+                    dcc.RadioItems(id='compare_series', value=rolling_windows[0],
+                                   options=[{'label': 'Daily', 'value': 0}] + [{'label': f'{w}-day avg', 'value': w} for w in rolling_windows],
+                                   labelStyle={'display': 'inline-block', 'margin-right': '10px'}, style={'color': 'white'})
+                ], className='dcc_compon'),
+                dcc.Graph(id='compare_chart', config={'displayModeBar': 'hover'})
+            ], className='create_container twelve columns')
+
+        ],className='row flex-display'),
+
+        #fourth row
         html.Div([
-            # map chart
-            dcc.Graph(id='map_chart', config={'displayModeBar': 'hover'})
-            # !!!!there are 12 columns in one row, this one is 5, pie is 4, Kpi is 3
-        ], className='create_container twelve columns',id='map')
-
-    ],className='row flex-display')
-
-],id= 'mainContainer',style={'display':'flex','flex-direction':'column'})
-
-#anytime we want to get user input to update/filter the graphs we need to create a callback
-@app.callback(Output('confirmed','figure'),[Input('w_countries','value')])
-
-def update_confirmed(w_countries):
-    covid_data_by_country = covid_data.groupby(['date', 'Country/Region'])[['confirmed', 'deaths', 'recovered', 'active']].sum().reset_index()
-    value_confirmed = covid_data_by_country[covid_data_by_country['Country/Region'] == w_countries]['confirmed'].iloc[-1] - covid_data_by_country[covid_data_by_country['Country/Region'] == w_countries]['confirmed'].iloc[-2]
-    delta_confirmed = covid_data_by_country[covid_data_by_country['Country/Region'] == w_countries]['confirmed'].iloc[-2] - covid_data_by_country[covid_data_by_country['Country/Region'] == w_countries]['confirmed'].iloc[-3]
-
-
-    return {
-       'data': [go.Indicator(
-           mode='number+delta',
-           value=value_confirmed,
-           delta={'reference': delta_confirmed,'position': 'right','valueformat':'g','relative':False,'font':{'size':15}},
-           number= {'valueformat': ',','font':{'size':20}},
-           domain= {'y':[0,1], 'x':[0,1]}
-       )],
-
-        'layout':go.Layout(
-           title={'text':'New Confirmed:',
-                  'y':0.98,'x':0.5,'xanchor':'center','yanchor':'top'},
-            height= 50,
-            font=dict(color='orange'),
-            paper_bgcolor='#1f2c56',
-            plot_bgcolor= '#1f2c56'
-            )
-        }
-
-#app call back for deaths
-@app.callback(Output('deaths','figure'),[Input('w_countries','value')])
-
-def update_confirmed(w_countries):
-    covid_data_by_country = covid_data.groupby(['date', 'Country/Region'])[['confirmed', 'deaths', 'recovered', 'active']].sum().reset_index()
-    value_confirmed = covid_data_by_country[covid_data_by_country['Country/Region'] == w_countries]['deaths'].iloc[-1] - covid_data_by_country[covid_data_by_country['Country/Region'] == w_countries]['deaths'].iloc[-2]
-    delta_confirmed = covid_data_by_country[covid_data_by_country['Country/Region'] == w_countries]['deaths'].iloc[-2] - covid_data_by_country[covid_data_by_country['Country/Region'] == w_countries]['deaths'].iloc[-3]
-
-
-    return {
-       'data': [go.Indicator(
-           mode='number+delta',
-           value=value_confirmed,
-           delta={'reference': delta_confirmed,'position': 'right','valueformat':'g','relative':False,'font':{'size':15}},
-           number= {'valueformat': ',','font':{'size':20}},
-           domain= {'y':[0,1], 'x':[0,1]}
-       )],
-
-        'layout':go.Layout(
-           title={'text':'New Deaths:',
-                  'y':0.98,'x':0.5,'xanchor':'center','yanchor':'top'},
-            height= 50,
-            font=dict(color='#dd1e35'),
-            paper_bgcolor='#1f2c56',
-            plot_bgcolor= '#1f2c56'
-            )
-        }
+            # third row map chart
+            html.Div([
+                # map chart
+                dcc.Graph(id='map_chart', config={'displayModeBar': 'hover'}),
+                #every map location for the global map, sent once per dataset
+                dcc.Store(id='map_data'),
+                #polls for a new dataset so the stores above follow the refreshes
+                dcc.Interval(id='data_refresh', interval=max(refresh_interval, 60)*1000, disabled=refresh_interval <= 0)
+                # !!!!there are 12 columns in one row, this one is 5, pie is 4, Kpi is 3
+            ], className='create_container twelve columns',id='map')
 
-#app call back for recovered
-@app.callback(Output('recovered','figure'),[Input('w_countries','value')])
+        ],className='row flex-display')
 
-def update_confirmed(w_countries):
-    covid_data_by_country = covid_data.groupby(['date', 'Country/Region'])[['confirmed', 'deaths', 'recovered', 'active']].sum().reset_index()
-    value_confirmed = covid_data_by_country[covid_data_by_country['Country/Region'] == w_countries]['recovered'].iloc[-1] - covid_data_by_country[covid_data_by_country['Country/Region'] == w_countries]['recovered'].iloc[-2]
-    delta_confirmed = covid_data_by_country[covid_data_by_country['Country/Region'] == w_countries]['recovered'].iloc[-2] - covid_data_by_country[covid_data_by_country['Country/Region'] == w_countries]['recovered'].iloc[-3]
+    ],id= 'mainContainer',style={'display':'flex','flex-direction':'column'})
 
+app.layout = serve_layout
 
+#everything the figures need for one country, sliced once per dropdown change
+def slice_country(data, w_countries):
     return {
-       'data': [go.Indicator(
-           mode='number+delta',
-           value=value_confirmed,
-           delta={'reference': delta_confirmed,'position': 'right','valueformat':'g','relative':False,'font':{'size':15}},
-           number= {'valueformat': ',','font':{'size':20}},
-           domain= {'y':[0,1], 'x':[0,1]}
-       )],
-
-        'layout':go.Layout(
-           title={'text':'New Recovered:',
+        'country': w_countries,
+        'dates': data['cube_dates'],
+        'series': data['country_cube'][:, data['country_index'][w_countries]],
+        'daily': data['daily'][:, data['country_index'][w_countries]],
+        'rolling': {w: average[:, data['country_index'][w_countries]] for w, average in data['rolling'].items()},
+        #only the map reads the location rows, a country without coordinates has none
+        'locations': data['covid_data_loc'],
+        'location_rows': data['location_slices'].get(w_countries, slice(0, 0)),
+        'center': data['dict_of_locations'][w_countries]
+    }
+
+#titles and colors of the kpi cards, in metric order
+kpi_cards = [
+    ('confirmed', 'New Confirmed:', 'orange'),
+    ('deaths', 'New Deaths:', '#dd1e35'),
+    ('recovered', 'New Recovered:', 'green'),
+    ('active', 'New Active:', 'purple')
+]
+
+def indicator_layout(title, color):
+    return go.Layout(
+           title={'text':title,
                   'y':0.98,'x':0.5,'xanchor':'center','yanchor':'top'},
             height= 50,
-            font=dict(color='green'),
+            font=dict(color=color),
             paper_bgcolor='#1f2c56',
             plot_bgcolor= '#1f2c56'
             )
-        }
-
-#app call back for active
-@app.callback(Output('active','figure'),[Input('w_countries','value')])
-
-def update_confirmed(w_countries):
-    covid_data_by_country = covid_data.groupby(['date', 'Country/Region'])[['confirmed', 'deaths', 'recovered', 'active']].sum().reset_index()
-    value_confirmed = covid_data_by_country[covid_data_by_country['Country/Region'] == w_countries]['active'].iloc[-1] - covid_data_by_country[covid_data_by_country['Country/Region'] == w_countries]['active'].iloc[-2]
-    delta_confirmed = covid_data_by_country[covid_data_by_country['Country/Region'] == w_countries]['active'].iloc[-2] - covid_data_by_country[covid_data_by_country['Country/Region'] == w_countries]['active'].iloc[-3]
-
 
+#last kpi_days of every country as one country x day x metric typed array,
+#the browser computes the kpi indicators from it so the cards cost no server time.
+#the cube is int64, float64 holds its totals exactly where int32 would wrap
+def kpi_payload(data):
     return {
-       'data': [go.Indicator(
-           mode='number+delta',
-           value=value_confirmed,
-           delta={'reference': delta_confirmed,'position': 'right','valueformat':'g','relative':False,'font':{'size':15}},
-           number= {'valueformat': ',','font':{'size':20}},
-           domain= {'y':[0,1], 'x':[0,1]}
-       )],
-
-        'layout':go.Layout(
-           title={'text':'New Active:',
-                  'y':0.98,'x':0.5,'xanchor':'center','yanchor':'top'},
-            height= 50,
-            font=dict(color='purple'),
-            paper_bgcolor='#1f2c56',
-            plot_bgcolor= '#1f2c56'
-            )
-        }
-
-#app call back for pie chart
-@app.callback(Output('pie_chart','figure'),[Input('w_countries','value')])
-
-def update_graph(w_countries):
-    covid_data_by_country = covid_data.groupby(['date', 'Country/Region'])[['confirmed', 'deaths', 'recovered', 'active']].sum().reset_index()
-    confirmed_value = covid_data_by_country[covid_data_by_country['Country/Region'] == w_countries]['confirmed'].iloc[-1]
-    death_value = covid_data_by_country[covid_data_by_country['Country/Region'] == w_countries]['deaths'].iloc[-1]
-    recovered_value = covid_data_by_country[covid_data_by_country['Country/Region'] == w_countries]['recovered'].iloc[-1]
-    active_value = covid_data_by_country[covid_data_by_country['Country/Region'] == w_countries]['active'].iloc[-1]
+        'version': data['data_version'],
+        'countries': list(data['country_index']),
+        'days': min(kpi_days, len(data['cube_dates'])),
+        'values': encode_array(data['country_cube'][-kpi_days:].transpose(1, 0, 2), 'f8'),
+        'cards': [{'metric': metric_index[metric], 'layout': indicator_layout(title, color)} for metric, title, color in kpi_cards]
+    }
+
+#figure for pie chart
+def pie_figure(country_slice):
+    w_countries = country_slice['country']
+    confirmed_value, death_value, recovered_value, active_value = country_slice['series'][-1]
 
     #list of colors for pie chart(one for each column above
     colors = ['orange','#dd1e35','green','purple']
@@ -305,43 +297,50 @@ def update_graph(w_countries):
             )
         }
 
-#app call back for line chart
-@app.callback(Output('line_chart','figure'),[Input('w_countries','value')])
-
-def update_graph(w_countries):
-    covid_data_by_country = covid_data.groupby(['date', 'Country/Region'])[['confirmed', 'deaths', 'recovered', 'active']].sum().reset_index()
-    covid_data_3 = covid_data_by_country[covid_data_by_country['Country/Region'] == w_countries][['Country/Region', 'date', 'confirmed']].reset_index()
-    covid_data_3['daily_confirmed'] = covid_data_3['confirmed'] - covid_data_3['confirmed'].shift(1)
-    # need a rolling average for the last 7 days for line graph
-    covid_data_3['rolling_avg'] = covid_data_3['daily_confirmed'].rolling(window=7).mean()
+#rows of the dates in [start_date, end_date], the last 30 days when no range is picked
+def date_rows(dates, start_date, end_date):
+    stop = dates.searchsorted(pd.Timestamp(end_date), side='right') if end_date else len(dates)
+    start = dates.searchsorted(pd.Timestamp(start_date)) if start_date else max(stop - 30, 0)
+    return slice(start, stop)
+
+#figure for line/bar chart
+def line_figure(country_slice):
+    w_countries = country_slice['country']
+    window = country_slice['window']
+    rows = date_rows(country_slice['dates'], country_slice['start_date'], country_slice['end_date'])
+    #daily values and rolling averages are precomputed, the chart only slices them
+    covid_data_3 = pd.DataFrame({
+        'date': country_slice['dates'][rows],
+        'daily_confirmed': country_slice['daily'][rows, metric_index['confirmed']],
+        'rolling_avg': country_slice['rolling'][window][rows, metric_index['confirmed']]
+    })
 
     #list of colors for pie chart(one for each column above
     colors = ['orange','#dd1e35','green','purple']
 
     return {
        'data': [go.Bar(
-           x=covid_data_3['date'].tail(30),
-           y=covid_data_3['daily_confirmed'].tail(30),
+           x=covid_data_3['date'],
+           y=covid_data_3['daily_confirmed'],
            name='Daily Confirmed Cases',
            marker=dict(color='orange'),
-           hoverinfo='text',
-           hovertext=
-                '<b>Date</b>: '+ covid_data_3['date'].tail(30).astype(str) + '<br>' +
-                '<b>Daily Confirmed Cases</b>: ' + [f'{x:,.0f}' for x in covid_data_3['daily_confirmed'].tail(30)]+ '<br>'+
-                '<b>Country</b>: ' + covid_data_3['Country/Region'].tail(30).astype(str) + '<br>'
+           #hover labels are formatted in the browser from the plotted values
+           hovertemplate=
+                '<b>Date</b>: %{x|%Y-%m-%d}<br>' +
+                '<b>Daily Confirmed Cases</b>: %{y:,.0f}<br>' +
+                '<b>Country</b>: ' + w_countries + '<br><extra></extra>'
 
        ),
            #line chart
            go.Scatter(
-               x=covid_data_3['date'].tail(30),
-               y=covid_data_3['rolling_avg'].tail(30),
-               name='Rolling Avg of the last 7 Days - Daily confirmed Cases',
+               x=covid_data_3['date'],
+               y=covid_data_3['rolling_avg'],
+               name=f'Rolling Avg of the last {window} Days - Daily confirmed Cases',
                line=dict(color='#FF00FF',width=3),
                mode='lines',
-               hoverinfo='text',
-               hovertext=
-               '<b>Date</b>: ' + covid_data_3['date'].tail(30).astype(str) + '<br>' +
-               '<b>Daily Confirmed Cases</b>: ' + [f'{x:,.0f}' for x in covid_data_3['rolling_avg'].tail(30)] + '<br>'
+               hovertemplate=
+               '<b>Date</b>: %{x|%Y-%m-%d}<br>' +
+               '<b>Daily Confirmed Cases</b>: %{y:,.0f}<br><extra></extra>'
 
            )
        ],
@@ -361,18 +360,67 @@ def update_graph(w_countries):
             )
         }
 
-# callback for map chart
-#app call back for line chart
-@app.callback(Output('map_chart','figure'),[Input('w_countries','value')])
+#one metric of several countries read from the precomputed series with a single fancy index,
+#(dates, countries), unknown countries are left out
+def slice_countries(data, countries, metric, window):
+    countries = [c for c in countries if c in data['country_index']][:compare_max]
+    rows = [data['country_index'][c] for c in countries]
+    source = data['rolling'][window] if window else data['daily']
+    return countries, source[:, rows, metric_index[metric]]
+
+#figure for the comparison chart, the selected countries and their combined total overlaid
+def compare_figure(data, countries, metric, window):
+    countries, series = slice_countries(data, countries, metric, window)
+    names = list(countries)
+    columns = list(series.T)
+    if len(countries) > 1:
+        names.append('Combined')
+        columns.append(series.sum(axis=1))
+    #every series gets an equal share of the points, long histories are downsampled to it
+    threshold = max(compare_points // max(len(columns), 1), 50)
+    kept = lttb(np.column_stack(columns), threshold) if columns else []
+    label = ('Daily ' if not window else f'{window}-day Avg of Daily ') + metric.capitalize()
+
+    traces = []
+    for j, (name, column) in enumerate(zip(names, columns)):
+        traces.append(go.Scatter(
+            x=data['cube_dates'][kept[:, j]],
+            y=column[kept[:, j]],
+            name=name,
+            mode='lines',
+            line=dict(width=3, dash='dot') if name == 'Combined' else dict(width=2),
+            hovertemplate=
+            '<b>Date</b>: %{x|%Y-%m-%d}<br>' +
+            '<b>' + label + '</b>: %{y:,.0f}<br>' +
+            '<b>Country</b>: ' + name + '<br><extra></extra>'
+        ))
+
+    return {
+        'data': traces,
+        'layout': go.Layout(
+            title={'text': label + ': ' + ', '.join(countries),
+                   'y':0.98,'x':0.5,'xanchor':'center','yanchor':'top'},
+            titlefont={'color':'white','size':20},
+            font=dict(family='sans-serif',color='white', size=12),
+            hovermode='closest',
+            paper_bgcolor='#1f2c56',
+            plot_bgcolor= '#1f2c56',
+            legend={'orientation':'h','bgcolor':'#1f2c56','xanchor':'center','x':0.5,'y':-0.2},
+            margin=dict(r=0),
+            xaxis=dict(title='<b>Date</b>',color='white',showline=True,showgrid=True,showticklabels=True, linecolor='white', linewidth=2,ticks='outside',tickfont=dict(family='Aerial',color='white',size=12)),
+            yaxis=dict(title='<b>' + label + '</b>', color='white', showline=True, showgrid=True, showticklabels=True, linecolor='white', linewidth=2, ticks='outside', tickfont=dict(family='Aerial',color='white',size=12))
+        )
+    }
 
-def update_graph(w_countries):
-    covid_data_loc = covid_data.groupby(['Lat', 'Long', 'Country/Region'])[['confirmed', 'deaths', 'recovered', 'active']].max().reset_index()
-    covid_data_loc_country = covid_data_loc[covid_data_loc['Country/Region'] == w_countries]
+#figure for map chart
+def map_figure(country_slice):
+    w_countries = country_slice['country']
+    covid_data_loc_country = country_slice['locations'].iloc[country_slice['location_rows']]
 
     if w_countries:
         zoom=2
-        zoom_lat = dict_of_locations[w_countries]['Lat']
-        zoom_long = dict_of_locations[w_countries]['Long']
+        zoom_lat = country_slice['center']['Lat']
+        zoom_long = country_slice['center']['Long']
 
     return {
        'data': [go.Scattermapbox(
@@ -380,18 +428,24 @@ def update_graph(w_countries):
            lat=covid_data_loc_country['Lat'],
            mode='markers',
            marker=go.scattermapbox.Marker(size=covid_data_loc_country['confirmed']/1000, color=covid_data_loc_country['confirmed'], colorscale='HSV',showscale=False,sizemode='area',opacity=0.3),
-           hoverinfo='text',
-           hovertext=
-           '<b>Country</b>: ' + covid_data_loc_country['Country/Region'].astype(str) + '<br>' +
-           '<b>Longitude</b>: ' + covid_data_loc_country['Long'].astype(str) + '<br>' +
-           '<b>Latitude</b>: ' + covid_data_loc_country['Lat'].astype(str) + '<br>' +
-           '<b>Confirmed Cases</b>: ' + [f'{x:,.0f}' for x in covid_data_loc_country['confirmed']] + '<br>'+
-           '<b>Deaths</b>: ' + [f'{x:,.0f}' for x in covid_data_loc_country['deaths']] + '<br>' +
-           '<b>Recovered Cases</b>: ' + [f'{x:,.0f}' for x in covid_data_loc_country['recovered']] + '<br>' +
-           '<b>Active Cases</b>: ' + [f'{x:,.0f}' for x in covid_data_loc_country['active']] + '<br>'
+           #the four metrics ride along as numbers and the browser formats the hover label
+           customdata=covid_data_loc_country[metrics].to_numpy(),
+           hovertemplate=
+           '<b>Country</b>: ' + w_countries + '<br>' +
+           '<b>Longitude</b>: %{lon}<br>' +
+           '<b>Latitude</b>: %{lat}<br>' +
+           '<b>Confirmed Cases</b>: %{customdata[0]:,.0f}<br>' +
+           '<b>Deaths</b>: %{customdata[1]:,.0f}<br>' +
+           '<b>Recovered Cases</b>: %{customdata[2]:,.0f}<br>' +
+           '<b>Active Cases</b>: %{customdata[3]:,.0f}<br><extra></extra>'
        )],
 
-        'layout':go.Layout(
+        'layout':map_layout(zoom_lat, zoom_long, zoom)
+        }
+
+#layout shared by the country map and the global map
+def map_layout(zoom_lat, zoom_long, zoom):
+    return go.Layout(
             hovermode='x',
             paper_bgcolor='#1f2c56',
             plot_bgcolor= '#1f2c56',
@@ -403,8 +457,156 @@ def update_graph(w_countries):
                 zoom=zoom),
             autosize=True
             )
-        }
 
+#every map location as typed arrays plus the per-country row ranges and centers,
+#the browser draws the global map from this and only recenters it when the country changes
+def map_payload(data):
+    covid_data_loc = data['covid_data_loc']
+    return {
+        'version': data['data_version'],
+        'countries': list(covid_data_loc['Country/Region'].cat.categories),
+        'country': encode_array(covid_data_loc['Country/Region'].cat.codes, 'i2'),
+        'lat': encode_array(covid_data_loc['Lat'], 'f4'),
+        'lon': encode_array(covid_data_loc['Long'], 'f4'),
+        'metrics': [encode_array(covid_data_loc[m], 'i4') for m in metrics],
+        'slices': {c: [s.start, s.stop] for c, s in data['location_slices'].items()},
+        'centers': data['dict_of_locations'],
+        'layout': map_layout(0, 0, 2)
+    }
+
+#figure builders for every output driven by the country dropdown
+country_builders = {
+    'pie_chart': pie_figure,
+    'line_chart': line_figure
+}
+if map_mode == 'country':
+    country_builders['map_chart'] = map_figure
+
+#chart options each figure depends on besides the country, they are part of its cache key
+line_options = {'window': rolling_windows[0], 'start_date': None, 'end_date': None}
+builder_options = {'line_chart': tuple(line_options)}
+
+figure_cache = FigureCache(cache_size, RedisBackend(cache_redis_url) if cache_redis_url else None)
+
+#figures for the given outputs from the cache, the missing ones are built from one shared country slice
+def country_figures(data, w_countries, output_ids, options=line_options):
+    country_slice = None
+    figures = []
+    for output_id in output_ids:
+        cache_id = '|'.join([output_id] + [str(options[name]) for name in builder_options.get(output_id, ())])
+        with timings.timer('cache'):
+            figure = figure_cache.get(cache_id, w_countries, data['data_version'])
+        if figure is None:
+            if country_slice is None:
+                with timings.timer('filter'):
+                    country_slice = dict(slice_country(data, w_countries), **options)
+            with timings.timer('figure'):
+                figure = country_builders[output_id](country_slice)
+            with timings.timer('serialize'):
+                value = figure_cache.encode(figure)
+            with timings.timer('cache'):
+                figure = figure_cache.set_encoded(cache_id, w_countries, data['data_version'], value)
+        figures.append(figure)
+    return figures
+
+#build the figures of the most selected countries as soon as a new dataset is swapped in
+def warm_figure_cache(new_dataset):
+    for country in figure_cache.popular(cache_warm_countries):
+        if country in new_dataset['country_index']:
+            country_figures(new_dataset, country, list(country_builders))
+
+refresher.on_refresh.append(warm_figure_cache)
+
+@app.server.route('/cache-stats')
+def cache_stats():
+    return flask.jsonify(figure_cache.stats())
+
+@app.server.route('/metrics')
+def metrics_endpoint():
+    stats = figure_cache.stats()
+    counters = {'covid_figure_cache_hits_total': stats['hits'], 'covid_figure_cache_misses_total': stats['misses']}
+    return flask.Response(timings.render(counters), mimetype='text/plain; version=0.0.4')
+
+#anytime we want to get user input to update/filter the graphs we need to create a callback
+#by default one callback returns every figure in a single response,
+#set COVID_SINGLE_CALLBACK=0 to register one callback per figure instead
+#the line chart also follows its rolling window and date range, in the order of line_options
+line_inputs = [Input('rolling_window','value'), Input('line_dates','start_date'), Input('line_dates','end_date')]
+
+if os.environ.get('COVID_SINGLE_CALLBACK', '1') != '0':
+    @app.callback([Output(output_id,'figure') for output_id in country_builders],[Input('w_countries','value')],
+                  [State(i.component_id, i.component_property) for i in line_inputs])
+
+    def update_country(w_countries, *option_values):
+        figure_cache.record_selection(w_countries)
+        return country_figures(dataset, w_countries, list(country_builders), dict(zip(line_options, option_values)))
+
+    #a new window or date range only sends the line chart again
+    @app.callback(Output('line_chart','figure',allow_duplicate=True),line_inputs,[State('w_countries','value')],prevent_initial_call=True)
+
+    def update_line_options(*values):
+        *option_values, w_countries = values
+        return country_figures(dataset, w_countries, ['line_chart'], dict(zip(line_options, option_values)))[0]
+else:
+    def make_callback(output_id):
+        def update_graph(w_countries, *option_values):
+            if output_id == 'pie_chart':
+                figure_cache.record_selection(w_countries)
+            options = dict(zip(line_options, option_values)) if option_values else line_options
+            return country_figures(dataset, w_countries, [output_id], options)[0]
+        return update_graph
+
+    for output_id in country_builders:
+        inputs = [Input('w_countries','value')] + (line_inputs if output_id == 'line_chart' else [])
+        app.callback(Output(output_id,'figure'),inputs)(make_callback(output_id))
+
+#all compared countries come back in one response, built from one batched lookup
+@app.callback(Output('compare_chart','figure'),
+              [Input('compare_countries','value'), Input('compare_metric','value'), Input('compare_series','value')])
+
+def update_comparison(countries, metric, window):
+    data = dataset
+    countries = countries or []
+    with timings.timer('cache'):
+        cache_id = f'compare_chart|{metric}|{window}'
+        figure = figure_cache.get(cache_id, '|'.join(countries), data['data_version'])
+    if figure is None:
+        with timings.timer('figure'):
+            figure = compare_figure(data, countries, metric, window)
+        with timings.timer('serialize'):
+            value = figure_cache.encode(figure)
+        with timings.timer('cache'):
+            figure = figure_cache.set_encoded(cache_id, '|'.join(countries), data['data_version'], value)
+    return figure
+
+#stores the browser renders from, each only goes out again when the dataset changed
+def register_data_store(store_id, build):
+    @app.callback(Output(store_id,'data'),[Input('data_refresh','n_intervals')],[State(store_id,'data')])
+
+    def update_store(n_intervals, stored):
+        data = dataset
+        if stored and stored['version'] == data['data_version']:
+            raise PreventUpdate
+        with timings.timer('figure'):
+            return figure_cache.get_or_build(store_id, 'all', data['data_version'], lambda: build(data))
+
+register_data_store('kpi_data', kpi_payload)
+app.clientside_callback(
+    ClientsideFunction(namespace='covid', function_name='kpi_figures'),
+    [Output(metric,'figure') for metric, _, _ in kpi_cards],
+    [Input('kpi_data','data'), Input('w_countries','value')]
+)
+
+if map_mode == 'global':
+    register_data_store('map_data', map_payload)
+    app.clientside_callback(
+        ClientsideFunction(namespace='covid', function_name='map_figure'),
+        Output('map_chart','figure'),
+        [Input('map_data','data'), Input('w_countries','value')]
+    )
+
+if refresh_interval > 0 and not refresh_after_fork:
+    refresher.start()
 
 if __name__ == '__main__':
     app.run_server(debug=True)
\ No newline at end of file
@@ -0,0 +1,476 @@
+import os
+import io
+import json
+import base64
+import hashlib
+import shutil
+import tempfile
+import contextlib
+import logging
+import threading
+import urllib.request
+import urllib.error
+import pandas as pd
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+#bump when the snapshot layout changes so older snapshots are ignored
+snapshot_format = 8
+
+#columns that identify a location in the wide csv files, every other column is a date
+id_columns = ['Province/State','Country/Region','Lat','Long']
+#a location is keyed by name only, coordinates differ slightly between the three files
+key_columns = ['Province/State','Country/Region']
+
+#metrics shown on the dashboard, in cube order
+metrics = ['confirmed','deaths','recovered','active']
+metric_index = {m: i for i, m in enumerate(metrics)}
+
+#daily counts per location fit in 32 bits, active can go negative so it stays signed
+count_dtype = np.int32
+
+#rolling average windows precomputed for the daily series
+rolling_windows = (7, 14, 28)
+
+#row of each table in the canonical location order, -1 where the table has no such location
+def location_rows(locations, table):
+    keys = pd.MultiIndex.from_frame(table[key_columns].astype(object).fillna(''))
+    canonical = pd.MultiIndex.from_frame(locations[key_columns].astype(object).fillna(''))
+    unique = ~keys.duplicated()
+    rows = keys[unique].get_indexer(canonical)
+    return np.where(rows >= 0, np.flatnonzero(unique)[rows], -1)
+
+#values of one wide table as a date x location block aligned to the canonical locations and dates
+def align_block(locations, dates, table):
+    block = np.zeros((len(dates), len(locations)), dtype=count_dtype)
+    table_dates = pd.to_datetime(table.columns[4:], format='%m/%d/%y')
+    rows = location_rows(locations, table)
+    columns = table_dates.get_indexer(dates)
+    found_rows, found_columns = rows >= 0, columns >= 0
+    values = table.iloc[:, 4:].to_numpy(dtype=np.float64, na_value=0)
+    block[np.ix_(found_columns, found_rows)] = values[np.ix_(rows[found_rows], columns[found_columns])].T
+    return block
+
+#rows of a table without a location of their own in the confirmed table, e.g. the country-level
+#recovered row of a country that confirmed splits by province, or a repeated key. their values are
+#added to their country in extra (date x country x metric) so the country totals keep them,
+#rows of countries confirmed does not know are logged and dropped
+def add_unmatched(locations, dates, table, metric, extra):
+    keys = pd.MultiIndex.from_frame(table[key_columns].astype(object).fillna(''))
+    canonical = pd.MultiIndex.from_frame(locations[key_columns].astype(object).fillna(''))
+    unmatched = table[~keys.isin(canonical) | keys.duplicated()]
+    if unmatched.empty:
+        return
+    codes = locations['Country/Region'].cat.categories.get_indexer(unmatched['Country/Region'])
+    if (codes < 0).any():
+        logger.warning('dropped %d %s rows of countries without confirmed cases: %s', (codes < 0).sum(), metric,
+                       ', '.join(map(str, unmatched['Country/Region'][codes < 0].unique())))
+    logger.info('added %d %s rows without a confirmed location to their country totals', (codes >= 0).sum(), metric)
+
+    columns = pd.to_datetime(table.columns[4:], format='%m/%d/%y').get_indexer(dates)
+    found = np.flatnonzero(columns >= 0)
+    block = unmatched.iloc[:, 4:].to_numpy(dtype=np.float64, na_value=0)[codes >= 0][:, columns[found]].astype(np.int64)
+    for m, sign in [(metric, 1), ('active', -1)]:
+        np.add.at(extra[:, :, metric_index[m]], (found[:, None], codes[codes >= 0][None, :]), sign * block.T)
+
+#align the three wide tables on an integer location id and stack them into one
+#date x location x metric block, the confirmed table defines the locations and dates.
+#extra holds the per-country values of the rows that have no confirmed location
+def ingest(confirmed, deaths, recovered):
+    locations = confirmed[id_columns].reset_index(drop=True)
+    locations['Province/State'] = locations['Province/State'].astype('category')
+    locations['Country/Region'] = locations['Country/Region'].astype('category')
+    dates = pd.DatetimeIndex(pd.to_datetime(confirmed.columns[4:], format='%m/%d/%y'))
+
+    values = np.empty((len(dates), len(locations), len(metrics)), dtype=count_dtype)
+    values[:, :, 0] = align_block(locations, dates, confirmed)
+    values[:, :, 1] = align_block(locations, dates, deaths)
+    values[:, :, 2] = align_block(locations, dates, recovered)
+    values[:, :, 3] = values[:, :, 0] - values[:, :, 1] - values[:, :, 2]
+
+    extra = np.zeros((len(dates), len(locations['Country/Region'].cat.categories), len(metrics)), dtype=np.int64)
+    add_unmatched(locations, dates, deaths, 'deaths', extra)
+    add_unmatched(locations, dates, recovered, 'recovered', extra)
+    return locations, dates, values, extra
+
+#dense date x country x metric cube so callbacks slice instead of running a groupby
+def build_country_cube(locations, values, extra):
+    countries = locations['Country/Region'].cat.categories
+    #country totals can outgrow 32 bits, the cube is small enough to keep them in 64
+    cube = extra.copy()
+    np.add.at(cube, (slice(None), locations['Country/Region'].cat.codes.to_numpy()), values)
+    country_index = {c: i for i, c in enumerate(countries)}
+    return country_index, cube
+
+#daily new values and their rolling averages for every country and metric, computed from the
+#cumulative cube in one vectorized pass. a w-day average of the daily values is (cube[i] - cube[i-w]) / w
+#and is undefined until w daily values exist, like pandas' rolling(w).mean() of a diff.
+#rows of a previous build are reused when the new cube only appended dates to it
+def build_daily_series(cube, previous=None):
+    start = 0
+    if previous is not None and previous['daily'].shape[1:] == cube.shape[1:] and previous['daily'].shape[0] <= cube.shape[0]:
+        start = previous['daily'].shape[0]
+        if not np.array_equal(previous['country_cube'], cube[:start]):
+            start = 0
+
+    daily = np.empty(cube.shape, dtype=np.float32)
+    daily[:start] = previous['daily'] if start else 0
+    first = max(start, 1)
+    daily[first:] = cube[first:] - cube[first - 1:-1]
+    if start == 0:
+        daily[0] = np.nan
+
+    rolling = {}
+    for window in rolling_windows:
+        average = np.empty(cube.shape, dtype=np.float32)
+        average[:start] = previous['rolling'][window] if start else 0
+        first = min(max(start, window), len(cube))
+        average[start:first] = np.nan
+        average[first:] = (cube[first:] - cube[first - window:first - window + len(cube) - first]) / window
+        rolling[window] = average
+    return daily, rolling
+
+#latest value per map location, sorted by country so each country is one contiguous block
+def build_location_table(locations, values):
+    covid_data_loc = locations[['Lat','Long','Country/Region']].copy()
+    for m in metrics:
+        covid_data_loc[m] = values[:, :, metric_index[m]].max(axis=0)
+    covid_data_loc = covid_data_loc.dropna(subset=['Lat','Long'])
+    covid_data_loc = covid_data_loc.sort_values('Country/Region', kind='stable').reset_index(drop=True)
+    return covid_data_loc, build_location_slices(covid_data_loc)
+
+#row range of each country in the sorted location table
+def build_location_slices(covid_data_loc):
+    sizes = covid_data_loc.groupby('Country/Region', sort=False, observed=True).size()
+    stops = sizes.cumsum()
+    return {c: slice(stop - size, stop) for c, size, stop in zip(sizes.index, sizes, stops)}
+
+#latest global value of each metric for the header cards, taken from the last date the metric was
+#reported (recovered stopped being reported and is zero after that) with its change from the day before
+def build_summary(dates, totals):
+    summary = {'date': dates[-1].strftime('%B %d, %Y')}
+    for m in metrics:
+        column = totals[:, metric_index[m]]
+        reported = np.flatnonzero(column)
+        last = int(reported[-1]) if len(reported) else len(column) - 1
+        value = int(column[last])
+        new = value - int(column[last - 1]) if last > 0 else value
+        summary[m] = {
+            'date': dates[last].strftime('%B %d, %Y'),
+            'value': value,
+            'new': new,
+            'percent': round(new / value * 100, 2) if value else 0.0
+        }
+    return summary
+
+#digest of everything the figures are built from: the country totals, the map locations with their
+#coordinates and counts, and the map centers. changes whenever any of them changes, including
+#revisions that keep the last date and changes between the locations of one country
+def data_version(country_cube, covid_data_loc, dict_of_locations):
+    digest = hashlib.sha1(np.ascontiguousarray(country_cube).tobytes())
+    digest.update(pd.util.hash_pandas_object(covid_data_loc, index=False).to_numpy().tobytes())
+    digest.update(json.dumps(dict_of_locations, sort_keys=True).encode())
+    return digest.hexdigest()[:16]
+
+#every table the app reads, rebuilt together and swapped in as one object,
+#previous is the dataset being served and lets the daily series be extended instead of rebuilt
+def build_dataset(confirmed, deaths, recovered, previous=None):
+    locations, dates, values, extra = ingest(confirmed, deaths, recovered)
+    country_index, country_cube = build_country_cube(locations, values, extra)
+
+    #global totals by date, from the countries so they include the rows without a location
+    summary = build_summary(dates, country_cube.sum(axis=1))
+
+    #create dict of list for map, the last row of a country wins
+    covid_data_list = locations.drop_duplicates('Country/Region', keep='last')
+    dict_of_locations = {c: {'Lat': lat, 'Long': long} for c, lat, long in zip(covid_data_list['Country/Region'], covid_data_list['Lat'], covid_data_list['Long'])}
+
+    covid_data_loc, location_slices = build_location_table(locations, values)
+    if previous is not None and previous['country_index'] != country_index:
+        previous = None
+    daily, rolling = build_daily_series(country_cube, previous)
+    #the location tables and the value block are only needed up to here and are not kept
+    return {
+        'version': str(confirmed.columns[-1]),
+        'data_version': data_version(country_cube, covid_data_loc, dict_of_locations),
+        'summary': summary,
+        'dict_of_locations': dict_of_locations,
+        'cube_dates': dates,
+        'country_index': country_index,
+        'country_cube': country_cube,
+        'daily': daily,
+        'rolling': rolling,
+        'covid_data_loc': covid_data_loc,
+        'location_slices': location_slices
+    }
+
+#typed array in plotly's {'dtype', 'bdata'} form, the browser decodes it without parsing json numbers
+def encode_array(values, dtype):
+    values = np.ascontiguousarray(values, dtype=np.dtype(dtype).newbyteorder('<'))
+    return {'dtype': dtype, 'bdata': base64.b64encode(values.tobytes()).decode('ascii')}
+
+#write each column as its own .npy file, text columns as categorical codes
+def save_frame(frame, path, name, meta):
+    columns = []
+    for i, column in enumerate(frame.columns):
+        values = frame[column]
+        entry = {'name': column, 'file': f'{name}-{i}.npy'}
+        if values.dtype.kind not in 'biufM':
+            values = values.astype('category')
+            entry['categories'] = values.cat.categories.tolist()
+            values = values.cat.codes
+        np.save(os.path.join(path, entry['file']), values.to_numpy())
+        columns.append(entry)
+    meta[name] = columns
+
+#numeric columns stay memory-mapped so workers share the pages instead of holding private copies
+def load_frame(path, columns):
+    data = {}
+    for entry in columns:
+        values = np.load(os.path.join(path, entry['file']), mmap_mode='r')
+        if 'categories' in entry:
+            values = pd.Categorical.from_codes(values, entry['categories'])
+        data[entry['name']] = values
+    return pd.DataFrame(data, copy=False)
+
+#snapshots live in one directory per format, last source date and data version, LATEST names the
+#current one and the older directories are removed once it is replaced. urls are the sources
+#the dataset was built from, a snapshot of other sources is not loaded
+def save_snapshot(dataset, snapshot_dir, urls=None):
+    os.makedirs(snapshot_dir, exist_ok=True)
+    date = pd.to_datetime(dataset['version'], format='%m/%d/%y').strftime('%Y-%m-%d')
+    name = f"v{snapshot_format}-{date}-{dataset['data_version']}"
+    path = os.path.join(snapshot_dir, name)
+    if not os.path.isdir(path):
+        tmp = tempfile.mkdtemp(prefix='.tmp-', dir=snapshot_dir)
+        try:
+            write_snapshot(dataset, tmp, urls)
+            os.rename(tmp, path)
+        except BaseException:
+            shutil.rmtree(tmp, ignore_errors=True)
+            raise
+
+    with open(os.path.join(snapshot_dir, '.LATEST'), 'w') as f:
+        f.write(name)
+    os.replace(os.path.join(snapshot_dir, '.LATEST'), os.path.join(snapshot_dir, 'LATEST'))
+    #readers that already mapped an older copy keep their pages after the files are unlinked
+    for entry in os.listdir(snapshot_dir):
+        if entry.startswith('v') and entry != name and os.path.isdir(os.path.join(snapshot_dir, entry)):
+            shutil.rmtree(os.path.join(snapshot_dir, entry), ignore_errors=True)
+    return path
+
+def write_snapshot(dataset, path, urls):
+    meta = {
+        'format': snapshot_format,
+        'urls': urls,
+        'version': dataset['version'],
+        'data_version': dataset['data_version'],
+        'countries': list(dataset['country_index']),
+        'summary': dataset['summary'],
+        'sources': dataset.get('sources', {}),
+        'dict_of_locations': dataset['dict_of_locations']
+    }
+    save_frame(dataset['covid_data_loc'], path, 'covid_data_loc', meta)
+    np.save(os.path.join(path, 'cube_dates.npy'), dataset['cube_dates'].to_numpy())
+    np.save(os.path.join(path, 'country_cube.npy'), dataset['country_cube'])
+    np.save(os.path.join(path, 'daily.npy'), dataset['daily'])
+    for window, average in dataset['rolling'].items():
+        np.save(os.path.join(path, f'rolling-{window}.npy'), average)
+    with open(os.path.join(path, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+
+#load the current snapshot, or None when there is none for this format and these source urls
+#or it holds the data_version given as loaded
+def load_snapshot(snapshot_dir, loaded=None, urls=None):
+    try:
+        with open(os.path.join(snapshot_dir, 'LATEST')) as f:
+            path = os.path.join(snapshot_dir, f.read().strip())
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+    except FileNotFoundError:
+        return None
+    if meta['format'] != snapshot_format or meta['data_version'] == loaded or meta.get('urls') != urls:
+        return None
+
+    covid_data_loc = load_frame(path, meta['covid_data_loc'])
+    dates = pd.DatetimeIndex(np.load(os.path.join(path, 'cube_dates.npy')))
+    return {
+        'version': meta['version'],
+        'data_version': meta['data_version'],
+        'summary': meta['summary'],
+        'sources': meta['sources'],
+        'dict_of_locations': meta['dict_of_locations'],
+        'cube_dates': dates,
+        'country_index': {c: i for i, c in enumerate(meta['countries'])},
+        'country_cube': np.load(os.path.join(path, 'country_cube.npy'), mmap_mode='r'),
+        'daily': np.load(os.path.join(path, 'daily.npy'), mmap_mode='r'),
+        'rolling': {window: np.load(os.path.join(path, f'rolling-{window}.npy'), mmap_mode='r') for window in rolling_windows},
+        'covid_data_loc': covid_data_loc,
+        'location_slices': build_location_slices(covid_data_loc)
+    }
+
+#fetch a source only if it changed since the last poll, returns (None, validators) when unchanged
+def fetch_source(source, validators):
+    if source.startswith(('http://','https://')):
+        request = urllib.request.Request(source)
+        if validators.get('etag'):
+            request.add_header('If-None-Match', validators['etag'])
+        if validators.get('last_modified'):
+            request.add_header('If-Modified-Since', validators['last_modified'])
+        try:
+            with urllib.request.urlopen(request, timeout=60) as response:
+                return response.read(), {'etag': response.headers.get('ETag'), 'last_modified': response.headers.get('Last-Modified')}
+        except urllib.error.HTTPError as e:
+            if e.code == 304:
+                return None, validators
+            raise
+
+    mtime = os.path.getmtime(source)
+    if validators.get('mtime') == mtime:
+        return None, validators
+    with open(source, 'rb') as f:
+        return f.read(), {'mtime': mtime}
+
+#date columns of the previous table re-read with each update, revisions of past days land in the
+#recent ones first
+revision_check_days = 7
+
+#parse only the date columns that are not in the previous table yet, together with the last known
+#ones to check they were not revised. falls back to a full parse when the rows or the older columns
+#changed, or when the content changed without adding a date (a revision of older values)
+def parse_source(content, previous):
+    columns = pd.read_csv(io.BytesIO(content), nrows=0).columns
+    if previous is not None and list(columns[:len(previous.columns)]) == list(previous.columns):
+        new_dates = list(columns[len(previous.columns):])
+        if not new_dates:
+            return pd.read_csv(io.BytesIO(content))
+        known_dates = list(previous.columns[len(id_columns):][-revision_check_days:])
+        update = pd.read_csv(io.BytesIO(content), usecols=id_columns + known_dates + new_dates)[id_columns + known_dates + new_dates]
+        if update[id_columns].equals(previous[id_columns]) and update[known_dates].equals(previous[known_dates]):
+            return pd.concat([previous, update[new_dates]], axis=1)
+    return pd.read_csv(io.BytesIO(content))
+
+#polls the sources in a background thread and swaps in a rebuilt dataset when any of them changed
+class DataRefresher:
+    def __init__(self, sources, interval, snapshot_dir=None, timings=None):
+        self.sources = sources
+        self.interval = interval
+        self.snapshot_dir = snapshot_dir
+        self.timings = timings
+        self.validators = {name: {} for name in sources}
+        self.tables = {name: None for name in sources}
+        #digest of the content each table was parsed from, a refetch of the same bytes is not a change
+        self.digests = {name: None for name in sources}
+        #the dataset being served and its last source date
+        self.dataset = None
+        self.version = None
+        self.on_refresh = []
+        self._stop = threading.Event()
+        self._thread = None
+        self._lock_file = None
+
+    def _stage(self, stage):
+        return self.timings.timer(stage, 'refresh') if self.timings is not None else contextlib.nullcontext()
+
+    #poll every source once, returns a new dataset or None when nothing changed
+    def refresh(self):
+        contents, validators = {}, {}
+        with self._stage('fetch'):
+            for name, source in self.sources.items():
+                content, validators[name] = fetch_source(source, self.validators[name])
+                if content is not None:
+                    contents[name] = content
+            #servers without validators and touched files send the same bytes again, a dataset
+            #loaded from a snapshot knows the digests of the sources it was built from
+            known = self.dataset.get('sources', {}) if self.dataset is not None else {}
+            digests = {name: hashlib.sha1(content).hexdigest() for name, content in contents.items()}
+            changed = [name for name in contents if digests[name] != (self.digests[name] or known.get(name))]
+            if not changed:
+                self.validators.update(validators)
+                return None
+            #a table that was never parsed (after a snapshot start) needs its source in full
+            for name, source in self.sources.items():
+                if self.tables[name] is None and name not in contents:
+                    contents[name], validators[name] = fetch_source(source, {})
+                    digests[name] = hashlib.sha1(contents[name]).hexdigest()
+
+        tables = dict(self.tables)
+        with self._stage('parse'):
+            for name, content in contents.items():
+                if tables[name] is None or name in changed:
+                    tables[name] = parse_source(content, tables[name])
+        with self._stage('aggregate'):
+            dataset = build_dataset(tables['confirmed'], tables['deaths'], tables['recovered'], self.dataset)
+        dataset['sources'] = {name: digests.get(name) or self.digests[name] for name in self.sources}
+
+        #validators and digests only move forward once the dataset is built, so a failed refresh
+        #is retried in full on the next poll instead of losing the changes it fetched
+        self.validators.update(validators)
+        self.digests = dict(dataset['sources'])
+        #the raw tables are only kept to parse the next refresh incrementally
+        self.tables = tables if self.interval > 0 else {name: None for name in self.sources}
+        self.dataset = dataset
+        self.version = dataset['version']
+        if self.snapshot_dir:
+            try:
+                with self._stage('snapshot'):
+                    save_snapshot(dataset, self.snapshot_dir, self.sources)
+            except OSError:
+                logger.exception('could not write covid data snapshot')
+        for callback in self.on_refresh:
+            callback(dataset)
+        return dataset
+
+    #several worker processes can share one snapshot directory: the one holding its lock file
+    #polls the sources and writes the snapshots, the others load them and map the same pages.
+    #the lock is kept for the life of the process and taken over when its holder exits
+    def _polls_sources(self):
+        if not self.snapshot_dir or self._lock_file is not None:
+            return True
+        try:
+            import fcntl
+        except ImportError:
+            return True
+        os.makedirs(self.snapshot_dir, exist_ok=True)
+        lock_file = open(os.path.join(self.snapshot_dir, '.refresh.lock'), 'a')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+        self._lock_file = lock_file
+        return True
+
+    #swap in a snapshot written by another process, returns it or None when it is not newer
+    def follow_snapshot(self):
+        with self._stage('snapshot'):
+            dataset = load_snapshot(self.snapshot_dir, self.dataset['data_version'] if self.dataset is not None else None, self.sources)
+        if dataset is None:
+            return None
+        self.dataset = dataset
+        self.version = dataset['version']
+        for callback in self.on_refresh:
+            callback(dataset)
+        return dataset
+
+    #one refresh cycle of the background thread
+    def poll(self):
+        return self.refresh() if self._polls_sources() else self.follow_snapshot()
+
+    def _run(self):
+        while True:
+            try:
+                self.poll()
+            except Exception:
+                logger.exception('covid data refresh failed')
+            if self._stop.wait(self.interval):
+                break
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='covid-data-refresh', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
@@ -0,0 +1,33 @@
+import numpy as np
+
+#largest-triangle-three-buckets: keeps the first and last point and, from each of threshold-2
+#equal buckets in between, the point forming the largest triangle with the point kept from the
+#previous bucket and the average of the next bucket.
+#y is (points, series) sharing one x axis, every series is downsampled in the same pass over the
+#buckets. returns the kept positions, (threshold, series), rows with a missing value in any series
+#(dates before a rolling window fills) are never kept
+def lttb(y, threshold):
+    y = np.asarray(y, dtype=np.float64)
+    finite = np.flatnonzero(np.isfinite(y).all(axis=1))
+    n = len(finite)
+    if threshold < 3 or n <= threshold:
+        return np.repeat(finite[:, None], y.shape[1], axis=1)
+
+    x = finite.astype(np.float64)
+    y = y[finite]
+    columns = np.arange(y.shape[1])
+    bounds = np.append(np.linspace(1, n - 1, threshold - 1).astype(np.int64), n)
+    kept = np.empty((threshold, y.shape[1]), dtype=np.int64)
+    kept[0] = 0
+    kept[-1] = n - 1
+    a = np.zeros(y.shape[1], dtype=np.int64)
+    for i in range(threshold - 2):
+        start, stop, next_stop = bounds[i], bounds[i + 1], bounds[i + 2]
+        next_x = x[stop:next_stop].mean()
+        next_y = y[stop:next_stop].mean(axis=0)
+        xa, ya = x[a], y[a, columns]
+        #twice the triangle areas, only their order matters
+        area = np.abs((xa - next_x) * (y[start:stop] - ya) - (xa - x[start:stop, None]) * (next_y - ya))
+        a = start + area.argmax(axis=0)
+        kept[i + 1] = a
+    return finite[kept]
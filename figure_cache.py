@@ -0,0 +1,107 @@
+import json
+import threading
+from collections import OrderedDict, Counter
+import plotly
+
+#in-process stand-in for a shared store, also used by the tests of the cache itself
+class LocalBackend:
+    def __init__(self):
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            return self._data.get(key)
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = value
+
+#redis store shared by every worker, entries expire on their own once a newer dataset replaces them
+class RedisBackend:
+    def __init__(self, url, ttl=86400):
+        import redis
+        self._client = redis.Redis.from_url(url)
+        self._ttl = ttl
+
+    def get(self, key):
+        value = self._client.get(key)
+        return value.decode() if value is not None else None
+
+    def set(self, key, value):
+        self._client.set(key, value, ex=self._ttl)
+
+#bounded LRU of built figures keyed by (output, country, data version), optionally
+#backed by a shared store that holds the serialized figures for the other workers
+class FigureCache:
+    def __init__(self, max_entries=256, backend=None):
+        self.max_entries = max_entries
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+        self.selections = Counter()
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _key(self, output_id, country, version):
+        return f'covid:figure:{version}:{output_id}:{country}'
+
+    def get(self, output_id, country, version):
+        key = self._key(output_id, country, version)
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+
+        value = self.backend.get(key) if self.backend is not None else None
+        with self._lock:
+            if value is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        figure = json.loads(value)
+        self._store(key, figure)
+        return figure
+
+    #plain json keeps hits cheap to serialize and lets other workers decode the entry
+    def encode(self, figure):
+        return json.dumps(figure, cls=plotly.utils.PlotlyJSONEncoder)
+
+    def set(self, output_id, country, version, figure):
+        return self.set_encoded(output_id, country, version, self.encode(figure))
+
+    #store a figure already encoded with encode, returns it decoded
+    def set_encoded(self, output_id, country, version, value):
+        figure = json.loads(value)
+        if self.backend is not None:
+            self.backend.set(self._key(output_id, country, version), value)
+        self._store(self._key(output_id, country, version), figure)
+        return figure
+
+    #cached figure, built and stored on a miss
+    def get_or_build(self, output_id, country, version, build):
+        figure = self.get(output_id, country, version)
+        if figure is None:
+            figure = self.set(output_id, country, version, build())
+        return figure
+
+    def _store(self, key, figure):
+        with self._lock:
+            self._entries[key] = figure
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def record_selection(self, country):
+        with self._lock:
+            self.selections[country] += 1
+
+    #countries to build ahead of time after a refresh
+    def popular(self, n):
+        with self._lock:
+            return [country for country, _ in self.selections.most_common(n)]
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'entries': len(self._entries), 'max_entries': self.max_entries}
@@ -0,0 +1,30 @@
+import os
+import gc
+import multiprocessing
+
+#gunicorn -c gunicorn.conf.py wsgi:application
+bind = os.environ.get('COVID_BIND', '0.0.0.0:8050')
+workers = int(os.environ.get('COVID_WORKERS', multiprocessing.cpu_count()))
+#threads per worker, so clients on slow connections do not hold up the other requests
+worker_class = 'gthread'
+threads = int(os.environ.get('COVID_THREADS', '4'))
+timeout = 120
+
+#the dataset is loaded once in the master before the workers are forked, they share its arrays
+#copy-on-write and the memory-mapped snapshot through the page cache
+preload_app = True
+
+#threads do not survive the fork, so the refresher is started in every worker instead of at import.
+#the workers share the snapshot directory: one of them polls the sources and writes snapshots,
+#the others load each new one (with COVID_SNAPSHOT_DIR empty every worker polls on its own)
+os.environ.setdefault('COVID_REFRESH_AFTER_FORK', '1')
+
+#objects loaded by the master are never collected, the collector would otherwise write to their
+#pages in every worker and undo the sharing
+def when_ready(server):
+    gc.freeze()
+
+def post_fork(server, worker):
+    import covid
+    if covid.refresh_interval > 0:
+        covid.refresher.start()
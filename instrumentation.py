@@ -0,0 +1,122 @@
+import os
+import time
+import bisect
+import random
+import logging
+import threading
+import cProfile
+from contextlib import contextmanager
+import flask
+
+logger = logging.getLogger(__name__)
+
+#upper bounds in seconds of the latency histogram buckets
+buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(buckets, seconds)] += 1
+        self.sum += seconds
+        self.count += 1
+
+#latency histograms per callback and stage, rendered in the prometheus text format
+class Timings:
+    def __init__(self):
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def observe(self, callback, stage, seconds):
+        with self._lock:
+            histogram = self._histograms.get((callback, stage))
+            if histogram is None:
+                histogram = self._histograms[(callback, stage)] = Histogram()
+            histogram.observe(seconds)
+
+    #time a block, inside a dash request it is booked on that request's callback
+    @contextmanager
+    def timer(self, stage, callback=None):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            if callback is None and flask.has_request_context() and 'callback' in flask.g:
+                callback = flask.g.callback
+                flask.g.stage_seconds += seconds
+            self.observe(callback or 'background', stage, seconds)
+
+    def render(self, counters=None):
+        lines = ['# HELP covid_callback_seconds Time spent per callback and stage.', '# TYPE covid_callback_seconds histogram']
+        with self._lock:
+            for (callback, stage), histogram in sorted(self._histograms.items()):
+                labels = f'callback="{callback}",stage="{stage}"'
+                cumulative = 0
+                for bound, count in zip(buckets, histogram.counts):
+                    cumulative += count
+                    lines.append(f'covid_callback_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+                lines.append(f'covid_callback_seconds_bucket{{{labels},le="+Inf"}} {histogram.count}')
+                lines.append(f'covid_callback_seconds_sum{{{labels}}} {histogram.sum}')
+                lines.append(f'covid_callback_seconds_count{{{labels}}} {histogram.count}')
+        for name, value in (counters or {}).items():
+            lines.append(f'# TYPE {name} counter')
+            lines.append(f'{name} {value}')
+        return '\n'.join(lines) + '\n'
+
+#profiles a random sample of requests and keeps the ones slower than the threshold
+class SlowRequestProfiler:
+    def __init__(self, sample_rate, threshold, directory):
+        self.sample_rate = sample_rate
+        self.threshold = threshold
+        self.directory = directory
+        #only one profiler can be active at a time, concurrent sampled requests are skipped
+        self._busy = threading.Lock()
+
+    def start(self):
+        if random.random() >= self.sample_rate or not self._busy.acquire(blocking=False):
+            return None
+        profile = cProfile.Profile()
+        profile.enable()
+        return profile
+
+    def finish(self, profile, callback, seconds):
+        profile.disable()
+        self._busy.release()
+        if seconds < self.threshold:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, f"{time.strftime('%Y%m%d-%H%M%S')}-{callback.replace('.', '_').replace(',', '-')}.prof")
+        profile.dump_stats(path)
+        logger.warning('slow callback %s took %.0f ms, profile written to %s', callback, seconds * 1000, path)
+
+#time every dash callback request; whatever the explicit stages do not cover is the
+#framework's own work (parsing the request, encoding the response) and is booked as 'framework'
+def instrument_dash(app, timings, profiler=None):
+    server = app.server
+
+    @server.before_request
+    def start_callback_timer():
+        if not flask.request.path.endswith('/_dash-update-component'):
+            return
+        body = flask.request.get_json(silent=True) or {}
+        #outputs with allow_duplicate carry an @<hash> suffix, dropped so each output keeps one series
+        outputs = body.get('output', '').strip('.').split('...')
+        flask.g.callback = ','.join(output.split('@')[0] for output in outputs)
+        flask.g.stage_seconds = 0.0
+        flask.g.profile = profiler.start() if profiler is not None else None
+        flask.g.callback_start = time.perf_counter()
+
+    #teardown also runs for failed requests, so a sampled profile is always released
+    @server.teardown_request
+    def stop_callback_timer(error=None):
+        if 'callback_start' not in flask.g:
+            return
+        seconds = time.perf_counter() - flask.g.callback_start
+        timings.observe(flask.g.callback, 'total', seconds)
+        timings.observe(flask.g.callback, 'framework', max(seconds - flask.g.stage_seconds, 0.0))
+        if flask.g.profile is not None:
+            profiler.finish(flask.g.profile, flask.g.callback, seconds)
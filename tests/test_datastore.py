@@ -0,0 +1,179 @@
+import os
+import pandas as pd
+import pytest
+import datastore
+
+dates = ['1/22/20', '1/23/20', '1/24/20']
+rows = [('', 'Italy', 41.9, 12.6), ('Ontario', 'Canada', 51.2, -85.3), ('Quebec', 'Canada', 52.9, -73.5)]
+
+#wide csv of one metric, value of row r on day d is scale * (r + 1) * (d + 1)
+def write_source(path, scale, days=dates):
+    previous = os.stat(path).st_mtime_ns if os.path.exists(path) else 0
+    table = pd.DataFrame(rows, columns=datastore.id_columns)
+    for d, date in enumerate(days):
+        table[date] = [scale * (r + 1) * (d + 1) for r in range(len(rows))]
+    table.to_csv(path, index=False)
+    #a rewrite within the same second must still look changed to the mtime and Last-Modified checks
+    touch(path, max(os.stat(path).st_mtime_ns, previous + 2 * 10**9))
+
+def touch(path, mtime_ns=None):
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, mtime_ns or stat.st_mtime_ns + 2 * 10**9))
+
+@pytest.fixture
+def sources(tmp_path):
+    paths = {name: str(tmp_path / f'{name}.csv') for name in ['confirmed', 'deaths', 'recovered']}
+    write_source(paths['confirmed'], 100)
+    write_source(paths['deaths'], 1)
+    write_source(paths['recovered'], 10)
+    return paths
+
+def country_total(dataset, country, metric):
+    return int(dataset['country_cube'][-1, dataset['country_index'][country], datastore.metric_index[metric]])
+
+def test_refresh_builds_dataset(sources):
+    refresher = datastore.DataRefresher(sources, 60)
+    dataset = refresher.refresh()
+    assert country_total(dataset, 'Canada', 'confirmed') == 100 * (2 + 3) * 3
+    assert country_total(dataset, 'Canada', 'active') == (100 - 1 - 10) * (2 + 3) * 3
+    assert refresher.refresh() is None
+
+def test_unchanged_content_is_not_rebuilt(sources):
+    refresher = datastore.DataRefresher(sources, 60)
+    refresher.refresh()
+    touch(sources['deaths'])
+    assert refresher.refresh() is None
+
+def test_new_date_is_appended(sources):
+    refresher = datastore.DataRefresher(sources, 60)
+    refresher.refresh()
+    days = dates + ['1/25/20']
+    write_source(sources['confirmed'], 100, days)
+    write_source(sources['deaths'], 1, days)
+    write_source(sources['recovered'], 10, days)
+    dataset = refresher.refresh()
+    assert dataset['version'] == '1/25/20'
+    assert country_total(dataset, 'Italy', 'confirmed') == 100 * 4
+
+def test_new_date_with_revised_past_days(sources):
+    refresher = datastore.DataRefresher(sources, 60)
+    refresher.refresh()
+    write_source(sources['confirmed'], 200, dates + ['1/25/20'])
+    dataset = refresher.refresh()
+    italy = dataset['country_cube'][:, dataset['country_index']['Italy'], datastore.metric_index['confirmed']]
+    assert italy.tolist() == [200, 400, 600, 800]
+    assert refresher.tables['confirmed']['1/22/20'].tolist() == [200, 400, 600]
+
+def test_single_source_change_after_snapshot_start(sources, tmp_path):
+    snapshot_dir = str(tmp_path / 'snapshot')
+    datastore.DataRefresher(sources, 60, snapshot_dir).refresh()
+
+    refresher = datastore.DataRefresher(sources, 60, snapshot_dir)
+    refresher.dataset = datastore.load_snapshot(snapshot_dir, urls=sources)
+    refresher.version = refresher.dataset['version']
+    assert refresher.refresh() is None
+
+    write_source(sources['confirmed'], 200)
+    dataset = refresher.refresh()
+    assert dataset is not None
+    assert country_total(dataset, 'Italy', 'confirmed') == 200 * 3
+    assert country_total(dataset, 'Italy', 'deaths') == 3
+
+def test_failed_refresh_keeps_changes_for_the_next_poll(sources):
+    refresher = datastore.DataRefresher(sources, 60)
+    refresher.refresh()
+
+    write_source(sources['confirmed'], 200)
+    os.rename(sources['deaths'], sources['deaths'] + '.moved')
+    with pytest.raises(OSError):
+        refresher.refresh()
+    os.rename(sources['deaths'] + '.moved', sources['deaths'])
+
+    dataset = refresher.refresh()
+    assert dataset is not None
+    assert country_total(dataset, 'Italy', 'confirmed') == 200 * 3
+
+def test_snapshot_replaces_older_directories(sources, tmp_path):
+    snapshot_dir = str(tmp_path / 'snapshot')
+    os.makedirs(os.path.join(snapshot_dir, 'v1-2020-01-01'))
+    refresher = datastore.DataRefresher(sources, 60, snapshot_dir)
+    refresher.refresh()
+    write_source(sources['confirmed'], 200)
+    refresher.refresh()
+
+    with open(os.path.join(snapshot_dir, 'LATEST')) as f:
+        latest = f.read()
+    assert [entry for entry in os.listdir(snapshot_dir) if entry.startswith('v')] == [latest]
+    assert country_total(datastore.load_snapshot(snapshot_dir, urls=sources), 'Italy', 'confirmed') == 200 * 3
+
+def test_failed_snapshot_write_leaves_nothing_behind(sources, tmp_path, monkeypatch):
+    snapshot_dir = str(tmp_path / 'snapshot')
+    dataset = datastore.DataRefresher(sources, 60).refresh()
+
+    def fail(dataset, path, urls):
+        open(os.path.join(path, 'values.npy'), 'w').close()
+        raise OSError('disk full')
+    monkeypatch.setattr(datastore, 'write_snapshot', fail)
+    with pytest.raises(OSError):
+        datastore.save_snapshot(dataset, snapshot_dir)
+    assert os.listdir(snapshot_dir) == []
+
+def test_country_level_rows_count_towards_their_country(sources):
+    #recovered reports Canada as one country-level row, confirmed splits it by province
+    table = pd.read_csv(sources['recovered'])
+    canada = table['Country/Region'] == 'Canada'
+    national = table[canada].iloc[:1].copy()
+    national['Province/State'] = None
+    national[dates] = table.loc[canada, dates].sum().to_numpy()
+    pd.concat([table[~canada], national]).to_csv(sources['recovered'], index=False)
+
+    dataset = datastore.DataRefresher(sources, 60).refresh()
+    assert country_total(dataset, 'Canada', 'recovered') == 10 * (2 + 3) * 3
+    assert country_total(dataset, 'Canada', 'active') == (100 - 1 - 10) * (2 + 3) * 3
+    assert dataset['summary']['recovered']['value'] == 10 * (1 + 2 + 3) * 3
+
+def test_http_sources_use_conditional_requests(sources, tmp_path):
+    import functools
+    import threading
+    import http.server
+
+    class Handler(http.server.SimpleHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), functools.partial(Handler, directory=str(tmp_path)))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        base = f'http://127.0.0.1:{server.server_address[1]}'
+        refresher = datastore.DataRefresher({name: f'{base}/{name}.csv' for name in sources}, 60)
+        assert refresher.refresh() is not None
+        assert all(validators.get('last_modified') for validators in refresher.validators.values())
+        assert refresher.refresh() is None
+
+        write_source(sources['confirmed'], 200)
+        dataset = refresher.refresh()
+        assert country_total(dataset, 'Italy', 'confirmed') == 200 * 3
+    finally:
+        server.shutdown()
+        server.server_close()
+
+def test_snapshot_of_other_sources_is_not_loaded(sources, tmp_path):
+    snapshot_dir = str(tmp_path / 'snapshot')
+    datastore.DataRefresher(sources, 60, snapshot_dir).refresh()
+    assert datastore.load_snapshot(snapshot_dir, urls=sources) is not None
+    assert datastore.load_snapshot(snapshot_dir, urls=dict(sources, confirmed=sources['deaths'])) is None
+
+def test_moved_coordinates_change_the_data_version(sources, tmp_path):
+    snapshot_dir = str(tmp_path / 'snapshot')
+    refresher = datastore.DataRefresher(sources, 60, snapshot_dir)
+    before = refresher.refresh()['data_version']
+
+    table = pd.read_csv(sources['confirmed'])
+    table.loc[table['Province/State'] == 'Ontario', 'Lat'] = 10.0
+    table.to_csv(sources['confirmed'], index=False)
+    touch(sources['confirmed'])
+    dataset = refresher.refresh()
+    assert dataset['data_version'] != before
+    snapshot = datastore.load_snapshot(snapshot_dir, urls=sources)
+    assert snapshot['data_version'] == dataset['data_version']
+    assert 10.0 in snapshot['covid_data_loc']['Lat'].tolist()
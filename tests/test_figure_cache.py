@@ -0,0 +1,47 @@
+from figure_cache import FigureCache, LocalBackend
+
+def figure(title):
+    return {'data': [], 'layout': {'title': title}}
+
+def test_miss_then_hit():
+    cache = FigureCache(4)
+    assert cache.get('pie_chart', 'US', 'v1') is None
+    cache.set('pie_chart', 'US', 'v1', figure('US'))
+    assert cache.get('pie_chart', 'US', 'v1') == figure('US')
+    assert cache.get('pie_chart', 'US', 'v2') is None
+    assert cache.stats() == {'hits': 1, 'misses': 2, 'entries': 1, 'max_entries': 4}
+
+def test_get_or_build_builds_once():
+    cache = FigureCache(4)
+    builds = []
+    build = lambda: builds.append(1) or figure('US')
+    assert cache.get_or_build('line_chart', 'US', 'v1', build) == figure('US')
+    assert cache.get_or_build('line_chart', 'US', 'v1', build) == figure('US')
+    assert len(builds) == 1
+
+def test_least_recently_used_is_evicted():
+    cache = FigureCache(2)
+    cache.set('pie_chart', 'US', 'v1', figure('US'))
+    cache.set('pie_chart', 'Italy', 'v1', figure('Italy'))
+    cache.get('pie_chart', 'US', 'v1')
+    cache.set('pie_chart', 'Canada', 'v1', figure('Canada'))
+    assert cache.get('pie_chart', 'Italy', 'v1') is None
+    assert cache.get('pie_chart', 'US', 'v1') == figure('US')
+    assert cache.get('pie_chart', 'Canada', 'v1') == figure('Canada')
+    assert cache.stats()['entries'] == 2
+
+def test_backend_shares_figures_between_workers():
+    backend = LocalBackend()
+    first, second = FigureCache(4, backend), FigureCache(4, backend)
+    first.set('pie_chart', 'US', 'v1', figure('US'))
+    assert second.get('pie_chart', 'US', 'v1') == figure('US')
+    assert second.stats()['hits'] == 1
+    #the shared entry is now in the second worker's own lru as well
+    backend.set(second._key('pie_chart', 'US', 'v1'), None)
+    assert second.get('pie_chart', 'US', 'v1') == figure('US')
+
+def test_popular_countries():
+    cache = FigureCache(4)
+    for country in ['US', 'Italy', 'US', 'Canada', 'US', 'Italy']:
+        cache.record_selection(country)
+    assert cache.popular(2) == ['US', 'Italy']
@@ -0,0 +1,5 @@
+#production entry point, run with: gunicorn -c gunicorn.conf.py wsgi:application
+#python covid.py starts the single-process development server instead
+from covid import app
+
+application = app.server